@@ -0,0 +1,437 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+import importlib
+import os
+import random
+import resource
+import shutil
+import time
+
+from model import fisher
+from model import hook
+from model import learner
+from model import model_fn
+from model import net
+from optimizer import gradient_computer as gc
+from optimizer import metric
+from optimizer import optimizer as op
+from optimizer import spec
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0   # MB on Linux
+
+
+def make_spec(d_in, n_batch, n_train, n_task, args, model_dir='benchmark_model', n_epoch=1, **kwargs):
+    opt_spec = spec.OptimizerSpec(op.SGDOptimizer(5e-2), d_in)
+    options = dict(n_prefetch=args.n_prefetch, n_parallel=args.n_parallel, cache=args.cache_input,
+                   fisher_dtype=args.fisher_dtype, fisher_scale=args.fisher_scale, fisher_budget=args.fisher_budget,
+                   seed=args.seed)
+    options.update(kwargs)
+
+    return spec.LearningSpec(n_epoch, n_batch, n_train, n_task, model_dir, opt_spec, args.n_fed_step, args.n_fed_round,
+                             args.alpha, **options)
+
+
+def make_set_of_datasets(args, n_task):
+    np.random.seed(args.seed)
+    DataClass = getattr(importlib.import_module('dataset.set_of_dataset'), 'SetOf' + args.data)
+    if args.data[-5:] == 'BPERM':
+        return DataClass(n_task, args.n_block)
+
+    return DataClass(n_task)
+
+
+def synthetic_fisher(d_in, seed):
+    # heavy-tailed positive importances in the shapes of the main network
+    rng = np.random.RandomState(seed)
+    shapes = [(d_in, 50), (50,), (50, 50), (50,), (50, 10), (10,)]
+
+    return [rng.lognormal(-8.0, 3.0, shape).astype(np.float32) for shape in shapes]
+
+
+def measure_penalty(fisher_list, dtype, scale, n_step):
+    with tf.Graph().as_default():
+        weights = [tf.Variable(np.random.randn(*f.shape).astype(np.float32)) for f in fisher_list]
+        anchors = [np.random.randn(*f.shape).astype(np.float32) for f in fisher_list]
+        penalty = 0
+        for w, v, f in zip(weights, anchors, fisher_list):
+            values, scales = fisher.quantize(f, dtype, scale)
+            penalty = penalty + tf.math.reduce_sum(model_fn.dequantize(values, scales) * tf.math.square(w - v))
+        grads = tf.compat.v1.gradients(penalty, weights)
+
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            sess.run([penalty, grads])
+            start = time.time()
+            for _ in range(n_step):
+                sess.run([penalty, grads])
+
+            return (time.time() - start) / n_step
+
+
+def bench_fisher(args):
+    fisher_list = synthetic_fisher(784, args.seed)
+    total = sum(f.sum() for f in fisher_list)
+
+    for dtype, scale in [('float32', 'tensor'), ('float16', 'tensor'), ('float16', 'row'), ('int8', 'tensor'), ('int8', 'row')]:
+        n_bytes, error, zeros = 0, 0.0, 0
+        for f in fisher_list:
+            values, scales = fisher.quantize(f, dtype, scale)
+            restored = fisher.dequantize(values, scales)
+            n_bytes += values.nbytes + (scales.nbytes if scales is not None else 0)
+            error += np.abs(restored - f).sum()
+            zeros += int(np.count_nonzero((restored == 0) & (f != 0)))
+
+        step = measure_penalty(fisher_list, dtype, scale, args.n_step)
+        print(dtype, scale, "bytes: ", n_bytes, " relative L1 error: ", round(error / total, 5),
+              " flushed to zero: ", zeros, " penalty+grad (ms): ", round(step * 1000, 4))
+
+
+def bench_fisher_accuracy(args):
+    matrices = {}
+    for dtype in ['float32', args.fisher_dtype]:
+        set_of_datasets = make_set_of_datasets(args, args.n_task)
+        dataset = set_of_datasets.list[0]
+        model_dir = 'benchmark_fisher_' + dtype
+        shutil.rmtree(model_dir, ignore_errors=True)
+        learning_specs = [make_spec(dataset.d_in, args.n_batch, dataset.n_train, args.n_task, args, model_dir,
+                                    fisher_dtype=dtype) for _ in range(args.n_task)]
+        # same initial weights for both formats, so the delta is the quantization's and not the seed's: the graph
+        # seed covers TF 1, unseeded Keras initializers on TF 2 draw from Python's random
+        random.seed(args.seed)
+        run_config = tf.estimator.RunConfig(model_dir=model_dir, save_checkpoints_steps=int(dataset.n_train / args.n_batch),
+                                            tf_random_seed=args.seed)
+
+        # QEWC always quantizes, so the float32 reference is the matching OEWC learner
+        model = args.model.replace('QEWC', 'OEWC') if dtype == 'float32' else args.model
+        ModelClass = getattr(importlib.import_module('model.grouplearner'), 'Group' + model + 'Learner')
+        matrices[dtype] = ModelClass(set_of_datasets, learning_specs, args.n_task, run_config).train_and_evaluate()
+
+        # the penalty's fisher constants live in the graph (.meta); the checkpoint's fisher/ variables stay float32
+        checkpoint = tf.train.latest_checkpoint(model_dir)
+        print(dtype, "graph (.meta) bytes: ", os.path.getsize(checkpoint + '.meta'),
+              " checkpoint data bytes: ", os.path.getsize(checkpoint + '.data-00000-of-00001'))
+
+    delta = matrices[args.fisher_dtype] - matrices['float32']
+    print("accuracy matrix (float32):\n", matrices['float32'])
+    print("accuracy matrix delta (" + args.fisher_dtype + " - float32):\n", delta)
+    print("average accuracy delta: ", metric.AverageAccuracy(matrices[args.fisher_dtype]).compute() -
+          metric.AverageAccuracy(matrices['float32']).compute())
+
+
+def measured_epochs(args, n_train, n_example):
+    # enough epochs for the warm-up batch and the measured steps of n_example rows each
+    return int(np.ceil((args.n_step + 1) * n_example / n_train))
+
+
+def measure_throughput(input_learner, dataset_fn, n_step):
+    with tf.Graph().as_default():
+        features, labels = input_learner.input_fn(dataset_fn)()
+        with tf.compat.v1.Session() as sess:
+            input_learner.input_hook.after_create_session(sess, None)
+            sess.run([features, labels])
+            start = time.time()
+            for _ in range(n_step):
+                sess.run([features, labels])
+
+            return n_step / (time.time() - start)
+
+
+def bench_input(args):
+    set_of_datasets = make_set_of_datasets(args, args.n_task)
+
+    if args.storage == 'float32':
+        # the previous layout: every task array normalized to float32 up front
+        sources = [set_of_datasets.base] if set_of_datasets.base is not None else set_of_datasets.list
+        for data in sources:
+            data.x_train = data.x_train.astype(np.float32) / 255.0
+            data.x_test = data.x_test.astype(np.float32) / 255.0
+
+    dataset = set_of_datasets.list[0]
+    learning_spec = make_spec(dataset.d_in, args.n_batch, dataset.n_train, args.n_task, args,
+                              n_epoch=measured_epochs(args, dataset.n_train, args.n_batch))
+    run_config = tf.estimator.RunConfig(model_dir=learning_spec.model_dir)
+    input_learner = learner.EstimatorLearner(dataset, learning_spec, run_config)
+
+    batches = measure_throughput(input_learner, input_learner.train_input_fn, args.n_step)
+
+    print("storage: ", args.storage)
+    print("peak RSS (MB): ", round(peak_rss(), 1))
+    print("input throughput (batch/s): ", round(batches, 1))
+    print("input throughput (sample/s): ", round(batches * args.n_batch, 1))
+
+
+def legacy_hm_input_fn(hm_learner):
+    # the per-element flat_map pipeline that MetaAlphaTrainEstimatorLearner used before the batched gathers
+    def map_fn(*z):
+        x, y = zip(*z)
+
+        return tf.data.Dataset.from_tensor_slices((tf.stack(x), tf.stack(y)))
+
+    def unfold_tuple(t1, t2, t3):
+        (f1, l1), (f2, l2), (f3, l3) = t1, t2, t3
+        normalize = hm_learner.normalize
+
+        return (normalize(f1), normalize(f2), normalize(f3)), (l1, l2, l3)
+
+    def input_fn():
+        tf_train0 = hm_learner.tensor_slices(hm_learner.dataset[0].train_data()).map(hm_learner.dataset[0].transform)
+        tf_train1 = hm_learner.tensor_slices(hm_learner.dataset[1].train_data()).map(hm_learner.dataset[1].transform)
+
+        dataset_tuple = (tf_train0, tf_train1)
+        tf_flat_train = tf.data.Dataset.zip(dataset_tuple).flat_map(map_fn)
+        tf_train = tf.data.Dataset.zip((tf_flat_train,) + dataset_tuple).map(unfold_tuple)
+
+        return tf_train.repeat(hm_learner.learning_spec.n_epoch).batch(2 * hm_learner.learning_spec.n_batch)
+
+    return input_fn
+
+
+def bench_hm(args):
+    set_of_datasets = make_set_of_datasets(args, 2)
+
+    joint_dataset = set_of_datasets.list[0:2]
+    learning_spec = make_spec(joint_dataset[0].d_in, args.n_batch, joint_dataset[0].n_train, 2, args,
+                              n_epoch=measured_epochs(args, joint_dataset[0].n_train, 2 * args.n_batch))
+    run_config = tf.estimator.RunConfig(model_dir=learning_spec.model_dir)
+    hm_learner = learner.MetaAlphaTrainEstimatorLearner(joint_dataset, learning_spec, learning_spec, run_config, 0)
+
+    if args.pipeline == 'legacy':
+        dataset_fn = legacy_hm_input_fn(hm_learner)
+    else:
+        dataset_fn = hm_learner.train_input_fn
+    batches = measure_throughput(hm_learner, dataset_fn, args.n_step)
+
+    print("pipeline: ", args.pipeline)
+    print("peak RSS (MB): ", round(peak_rss(), 1))
+    print("HM input throughput (batch/s): ", round(batches, 1))
+    print("HM input throughput (triple/s): ", round(batches * 2 * args.n_batch, 1))
+
+
+def bench_fisher_hook(args):
+    # step time of a training step with the per-layer accumulation hooks against the fused hook
+    d_in = 784
+    n_total = args.n_batch * args.n_fed_step
+    with tf.Graph().as_default():
+        global_step = tf.compat.v1.train.get_or_create_global_step()
+        rng = np.random.RandomState(args.seed)
+        features = tf.constant(rng.rand(args.n_batch, d_in).astype(np.float32))
+        labels = tf.constant(rng.randint(0, 10, args.n_batch).astype(np.int64))
+
+        model = net.Main(d_in).build()
+        logits = model(features)
+        loss = tf.keras.losses.CategoricalCrossentropy(from_logits=True)(tf.one_hot(labels, 10), logits)
+        opt = op.SGDOptimizer(5e-2).build()
+        grads_and_vars = list(zip(opt.get_gradients(loss=loss, params=model.weights), model.weights))
+        with tf.control_dependencies([global_step.assign_add(1)]):
+            train_op = opt.apply_gradients(grads_and_vars)
+
+        if args.hook == 'fused':
+            hooks = [hook.FusedSquareAccumulationGradientHook(grads_and_vars, args.n_batch, n_total)]
+        else:
+            hooks = [hook.SquareAccumulationGradientHook(gv, args.n_batch, n_total) for gv in grads_and_vars]
+
+        with tf.compat.v1.train.MonitoredSession(hooks=hooks) as sess:
+            for _ in range(100):
+                sess.run(train_op)
+            start = time.time()
+            for _ in range(args.n_step):
+                sess.run(train_op)
+            step = (time.time() - start) / args.n_step
+
+    print("hook: ", args.hook)
+    print("step time (ms): ", round(step * 1000, 4))
+
+
+def measure_penalty_gradient(args, n_task, penalty_gradient):
+    d_in = 784
+    learning_spec = make_spec(d_in, args.n_batch, 60000, n_task, args, fisher_dtype='float32')
+    with tf.Graph().as_default():
+        global_step = tf.compat.v1.train.get_or_create_global_step()
+        rng = np.random.RandomState(args.seed)
+        features = tf.constant(rng.rand(args.n_batch, d_in).astype(np.float32))
+        labels = tf.constant(rng.randint(0, 10, args.n_batch).astype(np.int64))
+
+        model = net.Main(d_in).build()
+        loss = tf.keras.losses.CategoricalCrossentropy(from_logits=True)(tf.one_hot(labels, 10), model(features))
+        opt = learning_spec.optimizer_spec.optimizer.build()
+
+        # one penalty term per past task, as before the terms are folded together
+        tasks = [(synthetic_fisher(d_in, args.seed + t), [rng.randn(*w.shape).astype(np.float32) for w in model.weights])
+                 for t in range(n_task)]
+        # each layer's penalty terms are built once: the penalty itself for autodiff, (penalty, gradient) otherwise
+        analytic = penalty_gradient != 'autodiff'
+        layers = [model_fn.sum_penalties([model_fn.ewc_penalty(w, anchors[i], fisher_list[i], learning_spec,
+                                                               gradient=analytic)
+                                          for fisher_list, anchors in tasks], analytic)
+                  for i, w in enumerate(model.weights)]
+        if analytic:
+            penalty_gradients = [args.alpha * tf.add_n(gradients) for _, gradients in layers]
+        else:
+            penalty = tf.add_n(layers)
+
+        with tf.control_dependencies([global_step.assign_add(1)]):
+            if penalty_gradient == 'autodiff':
+                grads = opt.get_gradients(loss=loss + args.alpha * penalty, params=model.weights)
+                train_op = opt.apply_gradients(list(zip(grads, model.weights)))
+            elif penalty_gradient == 'analytic':
+                grads_and_vars = gc.PenaltyGradientComputer(opt, loss, model.weights, penalty_gradients).compute()
+                train_op = opt.apply_gradients(grads_and_vars)
+            else:
+                grads = opt.get_gradients(loss=loss, params=model.weights)
+                learning_rate = learning_spec.optimizer_spec.optimizer.learning_rate
+                train_op = tf.group([w.assign_sub(learning_rate * (g + p))
+                                     for g, w, p in zip(grads, model.weights, penalty_gradients)])
+
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            for _ in range(100):
+                sess.run(train_op)
+            start = time.time()
+            for _ in range(args.n_step):
+                sess.run(train_op)
+
+            return (time.time() - start) / args.n_step
+
+
+def bench_penalty_gradient(args):
+    # training step time with the EWC penalty differentiated by autodiff against its closed-form gradient
+    for n_task in [1, 10, 30]:
+        for penalty_gradient in ['autodiff', 'analytic', 'fused_sgd']:
+            step = measure_penalty_gradient(args, n_task, penalty_gradient)
+            print("tasks: ", n_task, " penalty gradient: ", penalty_gradient, " step time (ms): ", round(step * 1000, 4))
+
+
+def legacy_meta_tensors(g_cur, g_joint, v_cur, v_pre, g_pre):
+    # previous layout: every list flattened and concatenated each step, dot product as a [P,1]x[P,1] matmul
+    def layer_to_flat(grads):
+        return tf.concat([tf.reshape(grad, [-1, 1]) for grad in grads], axis=0)
+
+    flat_g_pre, flat_g_cur = layer_to_flat(g_pre), layer_to_flat(g_cur)
+    flat_v_pre, flat_v_cur = layer_to_flat(v_pre), layer_to_flat(v_cur)
+    flat_g_joint = layer_to_flat(g_joint)
+    features = tf.stack([tf.reduce_sum(tf.matmul(flat_g_pre, flat_g_cur, transpose_a=True)),
+                         tf.norm(flat_v_cur - flat_v_pre)])
+
+    X = flat_g_joint - flat_g_cur
+    Y = tf.multiply(flat_g_pre, (flat_v_cur - flat_v_pre))
+    label = tf.reduce_sum(tf.multiply(X, X)) / (tf.reduce_sum(tf.multiply(X, Y)) + 1e-3)
+
+    return features, label
+
+
+def layerwise_meta_tensors(g_cur, g_joint, v_cur, v_pre, g_pre):
+    layer_dot = model_fn.MetaModelFNCreator.layer_dot
+    v_diff = [c - p for c, p in zip(v_cur, v_pre)]
+    features = tf.stack([layer_dot(g_pre, g_cur), tf.sqrt(layer_dot(v_diff, v_diff))])
+
+    X = [j - c for j, c in zip(g_joint, g_cur)]
+    Y = [f * (c - p) for f, c, p in zip(g_pre, v_cur, v_pre)]
+    label = layer_dot(X, X) / (layer_dot(X, Y) + 1e-3)
+
+    return features, label
+
+
+def bench_meta(args):
+    # per-step cost of the HM meta-features and meta-label on top of the current and joint gradients
+    x_shape = (32, 32, 3) if args.backbone == 'cnn' else (784,)
+    rng = np.random.RandomState(args.seed)
+    with tf.Graph().as_default():
+        model = net.MainCNN().build() if args.backbone == 'cnn' else net.Main(784).build()
+        cce = tf.keras.losses.CategoricalCrossentropy(from_logits=True)
+        g = []
+        for _ in range(2):
+            features = tf.constant(rng.rand(args.n_batch, *x_shape).astype(np.float32))
+            labels = tf.constant(rng.randint(0, 10, args.n_batch).astype(np.int64))
+            g.append(tf.compat.v1.gradients(cce(tf.one_hot(labels, 10), model(features)), model.weights))
+        g_cur, g_joint = g
+        g_pre = [tf.constant(rng.rand(*w.shape).astype(np.float32)) for w in model.weights]
+        v_pre = [tf.constant(rng.randn(*w.shape).astype(np.float32)) for w in model.weights]
+
+        meta_tensors = legacy_meta_tensors if args.meta == 'flat' else layerwise_meta_tensors
+        meta = meta_tensors(g_cur, g_joint, model.weights, v_pre, g_pre)
+
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            steps = {}
+            for name, fetches in [('gradients', [g_cur, g_joint]), ('meta', [g_cur, g_joint, meta])]:
+                for _ in range(20):
+                    sess.run(fetches)
+                start = time.time()
+                for _ in range(args.n_step):
+                    sess.run(fetches)
+                steps[name] = (time.time() - start) / args.n_step
+
+    print("backbone: ", args.backbone, " meta: ", args.meta)
+    print("parameters: ", sum(int(np.prod(w.shape)) for w in model.weights))
+    print("gradient step time (ms): ", round(steps['gradients'] * 1000, 4))
+    print("meta overhead per step (ms): ", round((steps['meta'] - steps['gradients']) * 1000, 4))
+
+
+def bench_resident(args):
+    # wall time per task of the Estimator group learners against their resident counterparts; with few training
+    # rows the difference is the per-task graph build, checkpoint, restore and warm start the resident path saves
+    times = {}
+    for model in ['Single', 'ResidentSingle', 'OEWC', 'ResidentOEWC']:
+        set_of_datasets = make_set_of_datasets(args, args.n_task)
+        if args.n_row > 0:
+            sources = [set_of_datasets.base] if set_of_datasets.base is not None else set_of_datasets.list
+            for data in sources:
+                data.x_train, data.y_train = data.x_train[:args.n_row], data.y_train[:args.n_row]
+                data.n_train = args.n_row
+        dataset = set_of_datasets.list[0]
+        model_dir = 'benchmark_resident_' + model
+        shutil.rmtree(model_dir, ignore_errors=True)
+        learning_specs = [make_spec(dataset.d_in, args.n_batch, dataset.n_train, args.n_task, args, model_dir)
+                          for _ in range(args.n_task)]
+        run_config = tf.estimator.RunConfig(model_dir=model_dir,
+                                            save_checkpoints_steps=max(int(dataset.n_train / args.n_batch), 1))
+
+        ModelClass = getattr(importlib.import_module('model.grouplearner'), 'Group' + model + 'Learner')
+        start = time.time()
+        ModelClass(set_of_datasets, learning_specs, args.n_task, run_config).train_and_evaluate()
+        times[model] = (time.time() - start) / args.n_task
+        print(model, " time per task (s): ", round(times[model], 3))
+
+    for model in ['Single', 'OEWC']:
+        print(model, " per-task time saved by the resident learner (s): ",
+              round(times[model] - times['Resident' + model], 3))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks')
+
+    parser.add_argument('--target', type=str, default='input', help='benchmark to run: input, hm, fisher, fisher_accuracy, fisher_hook, penalty_gradient, meta or resident')
+    parser.add_argument('--data', type=str, default='RandMNISTBPERM', help='Type of Dataset')
+    parser.add_argument('--storage', type=str, default='uint8', help='uint8 or float32 (previous layout)')
+    parser.add_argument('--pipeline', type=str, default='batched', help='HM input: batched or legacy (per-element flat_map)')
+    parser.add_argument('--meta', type=str, default='layerwise', help='HM meta tensors: layerwise or flat (previous concatenation)')
+    parser.add_argument('--backbone', type=str, default='main', help='network of the meta benchmark: main (FCN) or cnn')
+    parser.add_argument('--hook', type=str, default='fused', help='fisher accumulation: fused or per_layer')
+    parser.add_argument('--n_task', type=int, default=10, help='Number of tasks')
+    parser.add_argument('--n_block', type=int, default=7, help='Number of blocks in BPERM')
+    parser.add_argument('--n_batch', type=int, default=10, help='batch size')
+    parser.add_argument('--n_step', type=int, default=2000, help='measured steps')
+    parser.add_argument('--n_row', type=int, default=0, help='training rows per task of the resident benchmark (0: all)')
+    parser.add_argument('--n_prefetch', type=int, default=1, help='batches prefetched by the input pipeline (-1: autotune)')
+    parser.add_argument('--n_parallel', type=int, default=1, help='parallel calls of the input preprocessing (-1: autotune)')
+    parser.add_argument('--cache_input', action='store_true', help='cache the fed examples inside the input pipeline')
+    parser.add_argument('--model', type=str, default='FedQEWC', help='group learner of the accuracy benchmarks')
+    parser.add_argument('--alpha', type=float, default=1.0, help='Intensity of Regularization')
+    parser.add_argument('--n_fed_step', type=int, default=600, help='step per each round for Fed learning')
+    parser.add_argument('--n_fed_round', type=int, default=1, help='iteration round for Fed learning')
+    parser.add_argument('--fisher_dtype', type=str, default='int8', help='quantized fisher precision: float16 or int8')
+    parser.add_argument('--fisher_scale', type=str, default='row', help='fisher quantization scale: tensor or row')
+    parser.add_argument('--fisher_budget', type=float, default=1.0, help='fraction of fisher entries kept in the penalty (1: dense)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+    args = parser.parse_args()
+
+    globals()['bench_' + args.target](args)
+
+
+if __name__ == '__main__':
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+    main(None)
@@ -0,0 +1,160 @@
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+
+class TaskCache(object):
+    # entries are checksummed once before they are promoted; verify=True re-checks every array on each load
+    version = 2
+
+    def __init__(self, cache_dir, max_bytes=None, verify=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.verify = verify
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def load_or_build(self, data_class, *args):
+        key = self.key(data_class, args, np.random.get_state())
+        dataset, rng_state = self.load(key)
+        if dataset is not None:
+            np.random.set_state(rng_state)
+            return dataset
+
+        dataset = data_class(*args)
+        self.save(key, dataset, np.random.get_state())
+
+        return dataset
+
+    def key(self, data_class, args, rng_state):
+        digest = hashlib.sha1()
+        digest.update(str(self.version).encode())
+        digest.update((data_class.__module__ + '.' + data_class.__name__).encode())
+        for arg in args:
+            if isinstance(arg, np.ndarray):
+                digest.update(str(arg.dtype).encode() + str(arg.shape).encode())
+                digest.update(np.ascontiguousarray(arg).tobytes())
+            else:
+                digest.update(repr(arg).encode())
+
+        digest.update(rng_state[1].tobytes())
+        digest.update(repr(rng_state[2:]).encode())
+
+        return data_class.__name__ + '-' + digest.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.entry_dir(key), 'meta.json'))
+
+    def load(self, key):
+        path = self.entry_dir(key)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None, None
+
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+
+            attrs = dict(meta['attrs'])
+            for name, checksum in meta['arrays'].items():
+                array = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                if self.verify and self.checksum(array) != checksum:
+                    raise ValueError('checksum mismatch: ' + name)
+                attrs[name] = array
+        except (OSError, ValueError, KeyError) as e:
+            print('Drop cache entry', key, ':', e)
+            shutil.rmtree(path, ignore_errors=True)
+            return None, None
+
+        module_name, class_name = meta['class']
+        data_class = getattr(importlib.import_module(module_name), class_name)
+        dataset = data_class.__new__(data_class)
+        dataset.__dict__.update(attrs)
+
+        os.utime(meta_path)
+        rng_state = meta['rng_state']
+        rng_state = (rng_state[0], np.array(rng_state[1], dtype=np.uint32)) + tuple(rng_state[2:])
+
+        return dataset, rng_state
+
+    def save(self, key, dataset, rng_state):
+        arrays = {}
+        attrs = {}
+        for name, value in vars(dataset).items():
+            if isinstance(value, np.ndarray):
+                arrays[name] = value
+            elif isinstance(value, np.generic):
+                attrs[name] = value.item()
+            elif isinstance(value, (int, float, str, bool, type(None))):
+                attrs[name] = value
+            elif isinstance(value, (list, tuple, range)) and all(isinstance(v, (int, np.integer)) for v in value):
+                attrs[name] = [int(v) for v in value]
+            else:
+                return
+
+        tmp_path = os.path.join(self.cache_dir, 'tmp-' + str(os.getpid()) + '-' + key)
+        os.makedirs(tmp_path, exist_ok=True)
+        checksums = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            array_path = os.path.join(tmp_path, name + '.npy')
+            np.save(array_path, array)
+            checksums[name] = self.checksum(array)
+            if self.checksum(np.load(array_path, mmap_mode='r')) != checksums[name]:
+                print('Drop cache entry', key, ': checksum mismatch after write:', name)
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+
+        meta = {'class': [type(dataset).__module__, type(dataset).__name__],
+                'attrs': attrs,
+                'arrays': checksums,
+                'rng_state': [rng_state[0], rng_state[1].tolist()] + list(rng_state[2:])}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_path, self.entry_dir(key))
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('tmp-'):
+                continue
+            meta_path = os.path.join(self.entry_dir(key), 'meta.json')
+            if not os.path.exists(meta_path):
+                continue
+            size = self.entry_size(key)
+            entries.append((os.path.getmtime(meta_path), size, key))
+            total += size
+
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def entry_size(self, key):
+        path = self.entry_dir(key)
+
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    @staticmethod
+    def checksum(array):
+        return zlib.crc32(np.ascontiguousarray(array).view(np.uint8).reshape(-1)) & 0xffffffff
@@ -1,6 +1,87 @@
+import math
 import numpy as np
 import tensorflow as tf
-from PIL import Image
+
+
+remap_tables = {}
+
+
+def rotation_remap(row, angle, resample='nearest'):
+    key = (row, angle, resample)
+    if key in remap_tables:
+        return remap_tables[key]
+
+    # same inverse affine map as PIL.Image.rotate(angle)
+    theta = -math.radians(angle)
+    cos, sin = round(math.cos(theta), 15), round(math.sin(theta), 15)
+    center = row / 2.0
+    shift_x = cos * -center + sin * -center + center
+    shift_y = -sin * -center + cos * -center + center
+    y, x = np.meshgrid(np.arange(row), np.arange(row), indexing='ij')
+
+    if resample == 'nearest':
+        # PIL resolves nearest neighbours in 16.16 fixed point, so do the same to match it pixel for pixel
+        def fix(v):
+            return int(math.floor(v * 65536.0 + 0.5))
+
+        xx = fix(shift_x + cos * 0.5 + sin * 0.5) + y * fix(sin) + x * fix(cos)
+        yy = fix(shift_y + -sin * 0.5 + cos * 0.5) + y * fix(cos) + x * fix(-sin)
+        corners = [(xx >> 16, yy >> 16, np.ones(xx.shape))]
+    elif resample == 'bilinear':
+        xx = cos * (x + 0.5) + sin * (y + 0.5) + shift_x - 0.5
+        yy = -sin * (x + 0.5) + cos * (y + 0.5) + shift_y - 0.5
+        x0, y0 = np.floor(xx), np.floor(yy)
+        dx, dy = xx - x0, yy - y0
+        corners = [(x0, y0, (1 - dx) * (1 - dy)), (x0 + 1, y0, dx * (1 - dy)),
+                   (x0, y0 + 1, (1 - dx) * dy), (x0 + 1, y0 + 1, dx * dy)]
+    else:
+        raise ValueError('unknown resample: ' + resample)
+
+    index = []
+    weight = []
+    for xi, yi, w in corners:
+        inside = (xi >= 0) & (xi < row) & (yi >= 0) & (yi < row)
+        index.append(np.where(inside, yi * row + xi, 0).astype(np.int64).reshape(-1))
+        weight.append(np.where(inside, w, 0).astype(np.float32).reshape(-1))
+
+    remap_tables[key] = (np.stack(index), np.stack(weight))
+
+    return remap_tables[key]
+
+
+def apply_remap(x, remap):
+    index, weight = remap
+    if index.shape[0] == 1:
+        result = np.take(x, index[0], axis=1)
+        result[:, weight[0] == 0] = 0
+        return result
+
+    weight = weight.reshape(weight.shape + (1,) * (x.ndim - 2))
+
+    result = np.take(x, index[0], axis=1) * weight[0]
+    for i, w in zip(index[1:], weight[1:]):
+        result += np.take(x, i, axis=1) * w
+
+    if np.issubdtype(x.dtype, np.integer):
+        result = np.rint(result)
+
+    return result.astype(x.dtype)
+
+
+def permute_blocks(x, perm, n_grid, n_block):
+    n_sample = x.shape[0]
+    n_cover = n_grid * n_block
+    channel = x.shape[3:]
+
+    blocks = x[:, :n_cover, :n_cover].reshape((n_sample, n_grid, n_block, n_grid, n_block) + channel)
+    blocks = blocks.swapaxes(2, 3).reshape((n_sample, n_grid * n_grid, n_block, n_block) + channel)
+    blocks = blocks[:, np.argsort(perm)]
+    blocks = blocks.reshape((n_sample, n_grid, n_grid, n_block, n_block) + channel).swapaxes(2, 3)
+
+    result = np.zeros_like(x)
+    result[:, :n_cover, :n_cover] = blocks.reshape((n_sample, n_cover, n_cover) + channel)
+
+    return result
 
 
 class DataSet(object):
@@ -21,6 +102,111 @@ class DataSet(object):
         self.x_train = tuple[0]
         self.y_train = tuple[1]
 
+    def train_data(self):
+        return self.x_train, self.y_train
+
+    def test_data(self):
+        return self.x_test, self.y_test
+
+    def transform(self, x, y):
+        return x, y
+
+    def take(self, rows):
+        return self.x_train[rows], self.y_train[rows]
+
+    def pixel_index(self):
+        return None
+
+    def release_train(self):
+        self.x_train = None
+        self.y_train = None
+
+
+class DataSetView(object):
+    def __init__(self, base, index):
+        self.base = base
+        self.index = index
+        self.row = base.row
+        self.d_in = base.d_in
+        self.n_train = base.n_train
+        self.n_test = base.n_test
+
+    @property
+    def x_train(self):
+        return self.base.x_train[:, self.index]
+
+    @property
+    def y_train(self):
+        return self.base.y_train
+
+    @property
+    def x_test(self):
+        return self.base.x_test[:, self.index]
+
+    @property
+    def y_test(self):
+        return self.base.y_test
+
+    def train_data(self):
+        return self.base.x_train, self.base.y_train
+
+    def test_data(self):
+        return self.base.x_test, self.base.y_test
+
+    def transform(self, x, y):
+        return tf.gather(x, self.index, axis=-1), y
+
+    def take(self, rows):
+        return np.take(self.base.x_train[rows], self.index, axis=-1), self.base.y_train[rows]
+
+    def pixel_index(self):
+        return self.index
+
+    def release_train(self):
+        pass
+
+
+class MultiTaskDataSet(object):
+    # the training rows of several tasks seen as one concatenated dataset, gathered batch by batch
+    def __init__(self, datasets):
+        self.list = list(datasets)
+        self.n_task = len(self.list)
+        self.d_in = self.list[0].d_in
+        self.sizes = np.array([dataset.train_data()[1].shape[0] for dataset in self.list])
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)])
+        self.n_train = int(self.offsets[-1])
+
+        x, y = self.list[0].take(np.arange(1))
+        self.x_shape, self.x_dtype = x.shape[1:], x.dtype
+        self.y_dtype = y.dtype
+
+    def transform(self, x, y):
+        return x, y
+
+    def batches(self, n_batch, n_epoch, seed):
+        rng = np.random.RandomState(seed)
+        pending = np.empty(0, dtype=np.int64)
+        for _ in range(n_epoch):
+            pending = np.concatenate([pending, rng.permutation(self.n_train)])
+            while pending.shape[0] >= n_batch:
+                yield self.gather(pending[:n_batch])
+                pending = pending[n_batch:]
+
+        if pending.shape[0] > 0:
+            yield self.gather(pending)
+
+    def gather(self, index):
+        task = np.searchsorted(self.offsets, index, side='right') - 1
+        rows = index - self.offsets[task]
+
+        x = np.empty((index.shape[0],) + self.x_shape, dtype=self.x_dtype)
+        y = np.empty(index.shape[0], dtype=self.y_dtype)
+        for k in np.unique(task):
+            mask = task == k
+            x[mask], y[mask] = self.list[k].take(rows[mask])
+
+        return x, y
+
 
 class MNIST(DataSet):
     def __init__(self):
@@ -40,9 +226,7 @@ class MNIST(DataSet):
         self.x_test = self.x_test.reshape(self.x_test.shape[0], -1)   # (10000, 784)
 
     def normalize(self):
-        self.x_train = self.x_train.astype(np.float32) / 255.0   # (60000, 28, 28)
-        self.x_test = self.x_test.astype(np.float32) / 255.0   # (10000, 28, 28)
-
+        # pixels stay uint8 (60000, 28, 28); the input pipeline scales them to [0, 1] per batch
         self.y_train = self.y_train.astype(np.int64)  # (60000, )
         self.y_test = self.y_test.astype(np.int64)  # (10000, )
 
@@ -85,11 +269,8 @@ class MNISTPERM(MNIST):
         self.x_test = self.x_test[:, self.perm]
 
     def permute_label(self):
-        for i, label in enumerate(self.y_train):
-            self.y_train[i] = self.label_perm[label]
-
-        for j, label in enumerate(self.y_test):
-            self.y_test[j] = self.label_perm[label]
+        self.y_train = self.label_perm[self.y_train].astype(self.y_train.dtype)
+        self.y_test = self.label_perm[self.y_test].astype(self.y_test.dtype)
 
 
 class RandMNISTPERM(MNISTPERM):
@@ -99,6 +280,13 @@ class RandMNISTPERM(MNISTPERM):
         super(RandMNISTPERM, self).__init__(perm)
 
 
+class RandMNISTPERMView(DataSetView):
+    def __init__(self, base):
+        self.perm = np.random.permutation(base.d_in)
+        super(RandMNISTPERMView, self).__init__(base, self.perm)
+        self.label_perm = np.random.permutation(10)
+
+
 class RowMNISTPERM(MNISTPERM):
     def __init__(self, perm):
         super(RowMNISTPERM, self).__init__(perm)
@@ -117,6 +305,14 @@ class RandRowMNISTPERM(RowMNISTPERM):
         super(RandRowMNISTPERM, self).__init__(perm)
 
 
+class RandRowMNISTPERMView(DataSetView):
+    def __init__(self, base):
+        self.perm = np.random.permutation(base.row)
+        index = self.perm[:, None] * base.row + np.arange(base.row)
+        super(RandRowMNISTPERMView, self).__init__(base, index.reshape(-1))
+        self.label_perm = np.random.permutation(10)
+
+
 class ColMNISTPERM(MNISTPERM):
     def __init__(self, perm):
         super(ColMNISTPERM, self).__init__(perm)
@@ -135,6 +331,14 @@ class RandColMNISTPERM(ColMNISTPERM):
         super(RandColMNISTPERM, self).__init__(perm)
 
 
+class RandColMNISTPERMView(DataSetView):
+    def __init__(self, base):
+        self.perm = np.random.permutation(base.row)
+        index = np.arange(base.row)[:, None] * base.row + self.perm
+        super(RandColMNISTPERMView, self).__init__(base, index.reshape(-1))
+        self.label_perm = np.random.permutation(10)
+
+
 class WholeMNISTPERM(MNISTPERM):
     def __init__(self, row_perm, col_perm):
         super(WholeMNISTPERM, self).__init__(0)
@@ -159,6 +363,15 @@ class RandWholeMNISTPERM(WholeMNISTPERM):
         super(RandWholeMNISTPERM, self).__init__(self.row_perm, self.col_perm)
 
 
+class RandWholeMNISTPERMView(DataSetView):
+    def __init__(self, base):
+        self.row_perm = np.random.permutation(base.row)
+        self.col_perm = np.random.permutation(base.row)
+        index = self.row_perm[:, None] * base.row + self.col_perm
+        super(RandWholeMNISTPERMView, self).__init__(base, index.reshape(-1))
+        self.label_perm = np.random.permutation(10)
+
+
 class MNISTBPERM(MNISTPERM):
     def __init__(self, perm, n_grid):
         self.n_grid = n_grid
@@ -169,42 +382,11 @@ class MNISTBPERM(MNISTPERM):
         super(MNISTBPERM, self).__init__(perm)
 
     def permute(self):
-        for i, train_sample in enumerate(self.x_train):
-            tr_blocks = self.make_blocks(train_sample)
-            tr_perm_sample = self.permute_blocks(self.perm, tr_blocks)
-
-            self.x_train[i] = tr_perm_sample
-
-        for i, test_sample in enumerate(self.x_test):
-            te_blocks = self.make_blocks(test_sample)
-            te_perm_sample = self.permute_blocks(self.perm, te_blocks)
-
-            self.x_test[i] = te_perm_sample
+        self.x_train = permute_blocks(self.x_train, self.perm, self.n_grid, self.n_block)
+        self.x_test = permute_blocks(self.x_test, self.perm, self.n_grid, self.n_block)
 
         self.flatten()
 
-    def make_blocks(self, sample):
-        x = sample
-        blocks = []
-        for i in range(self.n_grid):
-            for j in range(self.n_grid):
-                n = self.n_block
-                sub_x = x[n*i:n*(i+1), n*j:n*(j+1)]
-                blocks.append(sub_x)
-
-        return blocks
-
-    def permute_blocks(self, perm, blocks):
-        perm_x = np.zeros((self.row, self.col), dtype=float)
-        for index, order in enumerate(perm):
-            i = int(order / self.n_grid)
-            j = order % self.n_grid
-            n = self.n_block
-
-            perm_x[n*i:n*(i+1), n*j:n*(j+1)] = blocks[index]
-
-        return perm_x
-
 
 class RandMNISTBPERM(MNISTBPERM):
     def __init__(self, n_grid):
@@ -214,25 +396,17 @@ class RandMNISTBPERM(MNISTBPERM):
 
 
 class MNISTROTA(MNIST):
-    def __init__(self, angle):
+    def __init__(self, angle, resample='nearest'):
         super(MNISTROTA, self).__init__()
         self.angle = angle
+        self.resample = resample
         self.x_train = self.rotate(self.x_train)
         self.x_test = self.rotate(self.x_test)
 
     def rotate(self, data):
-        data = data.reshape(-1, self.row, self.row)
-        shape = data.shape
-        result = np.zeros(shape)
-
-        for i in range(shape[0]):
-            img = Image.fromarray(data[i], mode='L')
-            result[i] = img.rotate(self.angle)
+        data = data.reshape(-1, self.d_in)
 
-        result = result.reshape(-1, self.d_in)
-        result = result.astype(np.float32)
-
-        return result
+        return apply_remap(data, rotation_remap(self.row, self.angle, self.resample))
 
 
 class RandMNISTROTA(MNISTROTA):
@@ -260,13 +434,7 @@ class MNISTSPLIT(MNIST):
         self.y_test = self.y_test[test_index]
 
     def obtain_index__from_label(self, y_tensor):
-        index_list = []
-        for label in self.label_list:
-            indexes = np.where(label == y_tensor)[0]
-            index_list.extend(indexes)
-            index_list.sort()
-
-        return index_list
+        return np.flatnonzero(np.isin(y_tensor, self.label_list))
 
 
 class CIFAR10(DataSet):
@@ -281,11 +449,7 @@ class CIFAR10(DataSet):
         (self.x_train, self.y_train), (self.x_test, self.y_test) = tf.keras.datasets.cifar10.load_data()
 
     def normalize(self):
-        self.x_train = self.x_train.astype(np.float32)  # (50000, 32, 32, 3)
-        self.x_test = self.x_test.astype(np.float32)  # (10000, 32, 32, 3)
-        self.x_train = self.x_train / 255.0
-        self.x_test = self.x_test / 255.0
-
+        # pixels stay uint8 (50000, 32, 32, 3); the input pipeline scales them to [0, 1] per batch
         self.y_train = self.y_train.astype(np.int64)
         self.y_test = self.y_test.astype(np.int64)
         self.y_train = self.y_train.reshape(self.y_train.shape[0])
@@ -305,9 +469,10 @@ class CIFAR10(DataSet):
 
 
 class CIFAR10ROTA(CIFAR10):
-    def __init__(self, angle):
+    def __init__(self, angle, resample='nearest'):
         super(CIFAR10ROTA, self).__init__()
         self.angle = angle
+        self.resample = resample
         self.x_train = self.rotate(self.x_train)
         self.x_test = self.rotate(self.x_test)
 
@@ -315,17 +480,10 @@ class CIFAR10ROTA(CIFAR10):
 
     def rotate(self, data):
         shape = data.shape
-        result = np.zeros(shape)
-
-        for i in range(shape[0]):
-            for j in range(3):
-                map = Image.fromarray(data[i,:,:,j], mode='L')
-                rotated_map = map.rotate(self.angle)
-                result[i,:,:,j] = np.array(rotated_map)
+        data = data.reshape(shape[0], self.row * self.row, 3)   # (50000, 1024, 3)
+        result = apply_remap(data, rotation_remap(self.row, self.angle, self.resample))
 
-        result = result.astype(np.float32)
-
-        return result
+        return result.reshape(shape)
 
 
 class RandCIFAR10ROTA(CIFAR10ROTA):
@@ -358,42 +516,11 @@ class CIFAR10BPERM(CIFAR10PERM):
         super(CIFAR10BPERM, self).__init__(perm)
 
     def permute(self):
-        for i, train_sample in enumerate(self.x_train):
-            tr_blocks = self.make_blocks(train_sample) # (32 ,32, 3)
-            tr_perm_sample = self.permute_blocks(self.perm, tr_blocks)
-
-            self.x_train[i] = tr_perm_sample
-
-        for i, test_sample in enumerate(self.x_test):
-            te_blocks = self.make_blocks(test_sample)
-            te_perm_sample = self.permute_blocks(self.perm, te_blocks)
-
-            self.x_test[i] = te_perm_sample
+        self.x_train = permute_blocks(self.x_train, self.perm, self.n_grid, self.n_block)   # (50000, 32, 32, 3)
+        self.x_test = permute_blocks(self.x_test, self.perm, self.n_grid, self.n_block)
 
         self.flatten()
 
-    def make_blocks(self, sample):
-        x = sample
-        blocks = []
-        for i in range(self.n_grid):
-            for j in range(self.n_grid):
-                n = self.n_block
-                sub_x = x[n*i:n*(i+1), n*j:n*(j+1), :]
-                blocks.append(sub_x)
-
-        return blocks
-
-    def permute_blocks(self, perm, blocks):
-        perm_x = np.zeros((self.row, self.col, 3), dtype=float)
-        for index, order in enumerate(perm):
-            i = int(order / self.n_grid)
-            j = order % self.n_grid
-            n = self.n_block
-
-            perm_x[n*i:n*(i+1), n*j:n*(j+1), :] = blocks[index]
-
-        return perm_x
-
 
 class RandCIFAR10PERM(CIFAR10PERM):
     def __init__(self):
@@ -401,6 +528,13 @@ class RandCIFAR10PERM(CIFAR10PERM):
         super(RandCIFAR10PERM, self).__init__(perm)
 
 
+class RandCIFAR10PERMView(DataSetView):
+    def __init__(self, base):
+        self.perm = np.random.permutation(base.row * base.row)
+        index = self.perm[:, None] * 3 + np.arange(3)
+        super(RandCIFAR10PERMView, self).__init__(base, index.reshape(-1))
+
+
 class RandCIFAR10BPERM(CIFAR10BPERM):
     def __init__(self, n_grid):
         self.grid_pixels = n_grid * n_grid
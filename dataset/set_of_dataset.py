@@ -1,11 +1,118 @@
+import atexit
+import multiprocessing
+import shutil
+import tempfile
+from concurrent import futures
+
 import numpy as np
 import dataset.dataset as ds
+from dataset.cache import TaskCache
+
+
+def build_seeded(data_class, args, task_seed, cache=None):
+    state = np.random.get_state()
+    np.random.seed(task_seed)
+    try:
+        if cache is None:
+            return data_class(*args)
+        return cache.load_or_build(data_class, *args)
+    finally:
+        np.random.set_state(state)
+
+
+def build_task_file(data_class, args, task_seed, cache_dir, key):
+    np.random.seed(task_seed)
+    dataset = data_class(*args)
+    TaskCache(cache_dir).save(key, dataset, np.random.get_state())
+
+    return key
+
+
+class TaskStream(object):
+    def __init__(self, data_class, args, task_seeds, cache=None):
+        self.data_class = data_class
+        self.args = args
+        self.task_seeds = task_seeds
+        self.temporary = cache is None
+        self.cache = cache if cache is not None else TaskCache(tempfile.mkdtemp(), verify=False)
+        self.tasks = {}
+        self.jobs = {}
+        self.current = -1
+        self.executor = futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self.task_seeds)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('task index out of range')
+
+        if i not in self.tasks:
+            self.tasks[i] = self.load(i)
+
+        if i > self.current:
+            self.current = i
+            self.prefetch(i + 1)
+
+        return self.tasks[i]
+
+    def release(self, i):
+        # only the group learner knows when a task's training data is no longer needed (Fed learners revisit tasks)
+        if i in self.tasks:
+            self.tasks[i].release_train()
+
+    def key(self, i):
+        return self.cache.key(self.data_class, self.args, np.random.RandomState(self.task_seeds[i]).get_state())
+
+    def submit(self, i, key):
+        self.jobs[i] = self.executor.submit(build_task_file, self.data_class, self.args, self.task_seeds[i],
+                                            self.cache.cache_dir, key)
+
+    def prefetch(self, i):
+        if i < len(self) and i not in self.tasks and i not in self.jobs:
+            key = self.key(i)
+            if not self.cache.contains(key):
+                self.submit(i, key)
+
+    def load(self, i):
+        key = self.key(i)
+        if i not in self.jobs:
+            dataset = self.cache.load(key)[0]
+            if dataset is not None:
+                return dataset
+            self.submit(i, key)
+
+        self.jobs.pop(i).result()
+        dataset = self.cache.load(key)[0]
+        if dataset is None:
+            dataset = build_seeded(self.data_class, self.args, self.task_seeds[i])
+
+        return dataset
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.temporary:
+            shutil.rmtree(self.cache.cache_dir, ignore_errors=True)
+        else:
+            self.cache.evict()
 
 
 class SetOfDataSet(object):
+    cache = None
+    n_worker = 0
+    seed = None
+    streaming = False
+
     def __init__(self, n_task):
         self.list = []
         self.n_task = n_task
+        self.base = None
         self.generate()
 
     def set_list(self, _list):
@@ -14,23 +121,88 @@ class SetOfDataSet(object):
     def generate(self):
         pass
 
+    def load_base(self):
+        pass
+
+    def release(self, i):
+        if isinstance(self.list, TaskStream):
+            self.list.release(i)
+
+    def build(self, data_class, *args):
+        if self.cache is None or issubclass(data_class, ds.DataSetView):
+            return data_class(*args)
+
+        return self.cache.load_or_build(data_class, *args)
+
+    def build_all(self, data_class, *args):
+        if self.streaming:
+            if not issubclass(data_class, ds.DataSetView):
+                return TaskStream(data_class, args, self.task_seeds(), self.cache)
+            # a view only holds a permutation of the shared base, so there is nothing to stream
+            print('Streaming ignored:', data_class.__name__, 'tasks are views of one shared base and are built eagerly')
+
+        # every path draws task i from the same per-task seed, so --n_worker never changes the tasks
+        task_seeds = self.task_seeds()
+        if self.n_worker <= 1 or issubclass(data_class, ds.DataSetView):
+            cache = None if issubclass(data_class, ds.DataSetView) else self.cache
+            return [build_seeded(data_class, args, task_seed, cache) for task_seed in task_seeds]
+
+        return self.build_parallel(data_class, args, task_seeds)
+
+    def task_seeds(self):
+        seed = self.seed if self.seed is not None else np.random.randint(2 ** 31)
+        seed_sequence = np.random.SeedSequence(seed)
+
+        return [int(child.generate_state(1)[0]) for child in seed_sequence.spawn(self.n_task)]
+
+    def build_parallel(self, data_class, args, task_seeds):
+        cache = self.cache if self.cache is not None else TaskCache(tempfile.mkdtemp(), verify=False)
+        keys = [cache.key(data_class, args, np.random.RandomState(task_seed).get_state()) for task_seed in task_seeds]
+        datasets = [cache.load(key)[0] for key in keys]
+
+        context = multiprocessing.get_context('spawn')
+        with futures.ProcessPoolExecutor(self.n_worker, mp_context=context) as executor:
+            jobs = {}
+            for i, (key, task_seed) in enumerate(zip(keys, task_seeds)):
+                if datasets[i] is None:
+                    jobs[executor.submit(build_task_file, data_class, args, task_seed, cache.cache_dir, key)] = i
+
+            for job in futures.as_completed(jobs):
+                i = jobs[job]
+                datasets[i] = cache.load(job.result())[0]
+                if datasets[i] is None:
+                    datasets[i] = build_seeded(data_class, args, task_seeds[i])
+
+        if cache is self.cache:
+            cache.evict()
+        else:
+            for dataset in datasets:
+                for name, value in vars(dataset).items():
+                    if isinstance(value, np.memmap):
+                        setattr(dataset, name, np.array(value))
+            shutil.rmtree(cache.cache_dir, ignore_errors=True)
+
+        return datasets
+
+    def shared_base(self):
+        if self.base is None:
+            self.base = self.load_base()
+
+        return self.base
+
+    def concat(self):
+        return ds.MultiTaskDataSet(self.list[i] for i in range(self.n_task))
+
 
 class SetOfMNIST(SetOfDataSet):
     def __init__(self, n_task):
         super(SetOfMNIST, self).__init__(n_task)
 
-    def concat(self):
-        x_train_list = []
-        y_train_list = []
-        for i in range(self.n_task):
-            x_train_list.append(self.list[i].x_train)
-            y_train_list.append(self.list[i].y_train)
-
-        multi_dataset = ds.MNIST()
-        multi_dataset.x_train = np.concatenate(x_train_list, axis=0)
-        multi_dataset.y_train = np.concatenate(y_train_list, axis=0)
+    def load_base(self):
+        base = self.build(ds.MNIST)
+        base.flatten()
 
-        return multi_dataset
+        return base
 
     def split(self, n_round, n_fed_batch):
         self.fed_list = []
@@ -55,7 +227,7 @@ class SetOfSwapBlock(SetOfDataSet):
 
     def generate(self):
         for index in range(self.n_task):
-            self.list.append(ds.MNISTBPERM(self.grid_perm, self.n_grid))
+            self.list.append(self.build(ds.MNISTBPERM, self.grid_perm, self.n_grid))
             for j in range(self.step):
                 self.swap_perm(index*(j+1))
 
@@ -74,11 +246,11 @@ class SetOfMNISTPlusMNISTBPERM(SetOfMNIST):
         super(SetOfMNISTPlusMNISTBPERM, self).__init__(n_task)
 
     def generate(self):
-        first_dataset = ds.MNIST()
+        first_dataset = self.build(ds.MNIST)
         first_dataset.reshape3D()
         self.list.append(first_dataset)
         for i in range(1, self.n_task):
-            temp_dataset = ds.RandMNISTBPERM(self.n_grid)
+            temp_dataset = self.build(ds.RandMNISTBPERM, self.n_grid)
             temp_dataset.reshape3D()
             self.list.append(temp_dataset)
 
@@ -88,8 +260,7 @@ class SetOfRandMNISTPERM(SetOfMNIST):
         super(SetOfRandMNISTPERM, self).__init__(n_task)
 
     def generate(self):
-        for i in range(self.n_task):
-            self.list.append(ds.RandMNISTPERM())
+        self.list = self.build_all(ds.RandMNISTPERMView, self.shared_base())
 
 
 class SetOfRandRowMNISTPERM(SetOfMNIST):
@@ -97,8 +268,7 @@ class SetOfRandRowMNISTPERM(SetOfMNIST):
         super(SetOfRandRowMNISTPERM, self).__init__(n_task)
 
     def generate(self):
-        for i in range(self.n_task):
-            self.list.append(ds.RandRowMNISTPERM())
+        self.list = self.build_all(ds.RandRowMNISTPERMView, self.shared_base())
 
 
 class SetOfRandColMNISTPERM(SetOfMNIST):
@@ -106,8 +276,7 @@ class SetOfRandColMNISTPERM(SetOfMNIST):
         super(SetOfRandColMNISTPERM, self).__init__(n_task)
 
     def generate(self):
-        for i in range(self.n_task):
-            self.list.append(ds.RandColMNISTPERM())
+        self.list = self.build_all(ds.RandColMNISTPERMView, self.shared_base())
 
 
 class SetOfRandWholeMNISTPERM(SetOfMNIST):
@@ -115,8 +284,7 @@ class SetOfRandWholeMNISTPERM(SetOfMNIST):
         super(SetOfRandWholeMNISTPERM, self).__init__(n_task)
 
     def generate(self):
-        for i in range(self.n_task):
-            self.list.append(ds.RandWholeMNISTPERM())
+        self.list = self.build_all(ds.RandWholeMNISTPERMView, self.shared_base())
 
 
 class SetOfRandMNISTBPERM(SetOfMNIST):
@@ -125,8 +293,7 @@ class SetOfRandMNISTBPERM(SetOfMNIST):
         super(SetOfRandMNISTBPERM, self).__init__(n_task)
 
     def generate(self):
-        for i in range(self.n_task):
-            self.list.append(ds.RandMNISTBPERM(self.n_grid))
+        self.list = self.build_all(ds.RandMNISTBPERM, self.n_grid)
 
 
 # class SetOfRandMNISTROTA(SetOfMNIST):
@@ -147,7 +314,7 @@ class SetOfRandMNISTROTA(SetOfMNIST):
         for i in range(self.n_task):
             cur_angle = angle_list[i]
             print(cur_angle)
-            self.list.append(ds.MNISTROTA(cur_angle))
+            self.list.append(self.build(ds.MNISTROTA, cur_angle))
 
 
 class SetOfGradualMNISTROTA(SetOfMNIST):
@@ -158,7 +325,7 @@ class SetOfGradualMNISTROTA(SetOfMNIST):
     def generate(self):
         for i in range(self.n_task):
             angle = int((i + 1) * 360 * self.range / self.n_task)
-            self.list.append(ds.MNISTROTA(angle))
+            self.list.append(self.build(ds.MNISTROTA, angle))
 
 
 class SetOfGradualMNISTSPLIT(SetOfMNIST):
@@ -170,7 +337,7 @@ class SetOfGradualMNISTSPLIT(SetOfMNIST):
         for i in range(self.n_task):
             label_list = range(10)[self.period*i:self.period*(i+1)]
             print(label_list)
-            self.list.append(ds.MNISTSPLIT(label_list))
+            self.list.append(self.build(ds.MNISTSPLIT, label_list))
 
 
 class SetOfCIFAR10(SetOfDataSet):
@@ -179,20 +346,14 @@ class SetOfCIFAR10(SetOfDataSet):
 
     def generate(self):
         for i in range(self.n_task):
-            self.list.append(ds.CIFAR10())
+            self.list.append(self.build(ds.CIFAR10))
 
-    def concat(self):
-        x_train_list = []
-        y_train_list = []
-        for i in range(self.n_task):
-            x_train_list.append(self.list[i].x_train)
-            y_train_list.append(self.list[i].y_train)
+    def load_base(self):
+        base = self.build(ds.CIFAR10)
+        base.flatten()
 
-        multi_dataset = ds.RandCIFAR10PERM()
-        multi_dataset.x_train = np.concatenate(x_train_list, axis=0)
-        multi_dataset.y_train = np.concatenate(y_train_list, axis=0)
+        return base
 
-        return multi_dataset
 
 
 class SetOfCIFAR10PlusCIFAR10BPERM(SetOfCIFAR10):
@@ -201,11 +362,11 @@ class SetOfCIFAR10PlusCIFAR10BPERM(SetOfCIFAR10):
         super(SetOfCIFAR10PlusCIFAR10BPERM, self).__init__(n_task)
 
     def generate(self):
-        first_dataset = ds.CIFAR10()
+        first_dataset = self.build(ds.CIFAR10)
         first_dataset.reshape3D()
         self.list.append(first_dataset)
         for i in range(1, self.n_task):
-            temp_dataset = ds.RandCIFAR10BPERM(self.n_grid)
+            temp_dataset = self.build(ds.RandCIFAR10BPERM, self.n_grid)
             temp_dataset.reshape3D()
             self.list.append(temp_dataset)
 
@@ -218,8 +379,7 @@ class SetOfRandCIFAR10PERM(SetOfCIFAR10):
         self.generate()
 
     def generate(self):
-        for i in range(self.n_task):
-            self.list.append(ds.RandCIFAR10PERM())
+        self.list = self.build_all(ds.RandCIFAR10PERMView, self.shared_base())
 
 
 class SetOfRandCIFAR10ROTA(SetOfCIFAR10):
@@ -227,8 +387,7 @@ class SetOfRandCIFAR10ROTA(SetOfCIFAR10):
         super(SetOfRandCIFAR10ROTA, self).__init__(n_task)
 
     def generate(self):
-        for i in range(self.n_task):
-            self.list.append(ds.RandCIFAR10ROTA())
+        self.list = self.build_all(ds.RandCIFAR10ROTA)
 
 
 class SetOfRandCIFAR10BPERM(SetOfCIFAR10):
@@ -237,5 +396,4 @@ class SetOfRandCIFAR10BPERM(SetOfCIFAR10):
         super(SetOfRandCIFAR10BPERM, self).__init__(n_task)
 
     def generate(self):
-        for i in range(self.n_task):
-            self.list.append(ds.RandCIFAR10BPERM(self.n_grid))
+        self.list = self.build_all(ds.RandCIFAR10BPERM, self.n_grid)
@@ -5,6 +5,8 @@ import importlib
 from optimizer import metric
 from result import logger
 
+from dataset import cache
+from dataset import set_of_dataset
 from model import grouplearner
 from optimizer import optimizer as op
 from optimizer import spec
@@ -26,11 +28,16 @@ def main(argv):
     parser.add_argument('--batch_size', type=int, default=100, help='batch size')
     parser.add_argument('--lr', type=float, default=5e-2, help='SGD learning rate for main network')
     parser.add_argument('--meta_lr', type=float, default=5e-2, help='SGD learning rate for HM')
+    parser.add_argument('--meta_update', type=str, default='baseline', help='HM test step: baseline or single_pass')
 
     # experiment parameters
     parser.add_argument('--n_task', type=int, default=10, help='Number of tasks')
     parser.add_argument('--n_block', type=int, default=7, help='Number of blocks in BPERM')
     parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--cache_dir', type=str, default='', help='directory of the task dataset cache')
+    parser.add_argument('--cache_size', type=float, default=20.0, help='size limit of the task cache (GB)')
+    parser.add_argument('--n_worker', type=int, default=0, help='processes for task generation (0, 1: in process); tasks depend only on --seed')
+    parser.add_argument('--streaming', action='store_true', help='build tasks on demand with prefetch of the next task (view families are built eagerly)')
     parser.add_argument('--save_path', type=str, default='results/', help='save models')
 
     args = parser.parse_args()
@@ -47,6 +54,12 @@ def main(argv):
     model_dir = args.model
     meta_model_dir = args.meta_model_dir
 
+    if args.cache_dir:
+        set_of_dataset.SetOfDataSet.cache = cache.TaskCache(args.cache_dir, int(args.cache_size * 2**30))
+    set_of_dataset.SetOfDataSet.n_worker = args.n_worker
+    set_of_dataset.SetOfDataSet.seed = seed
+    set_of_dataset.SetOfDataSet.streaming = args.streaming
+
     # generate sequence dataset
     DataClass = getattr(importlib.import_module('dataset.set_of_dataset'), 'SetOfRand' + args.data)
     # generate sequence dataset
@@ -68,9 +81,11 @@ def main(argv):
 
     # learning specs
     for i in range(n_task):
-        opt = op.SGDOptimizer(learning_rates[i]).build()
+        # the test model_fn builds the optimizer itself; the fisher hooks accumulate over one epoch of steps
+        opt = op.SGDOptimizer(learning_rates[i])
         opt_spec = spec.OptimizerSpec(opt, d_in)
-        learning_specs.append(spec.LearningSpec(n_epoch, n_batch, n_train, n_task, model_dir, opt_spec, alpha))
+        learning_specs.append(spec.LearningSpec(n_epoch, n_batch, n_train, n_task, model_dir, opt_spec,
+                                                int(n_train / n_batch), 1, alpha, meta_update=args.meta_update))
 
     my_grouplearner = grouplearner.GroupHMTestLearner(set_of_datasets, learning_specs, n_task, run_config, ws0, ws1)
 
@@ -3,6 +3,8 @@ import numpy as np
 import argparse
 import importlib
 
+from dataset import cache
+from dataset import set_of_dataset
 from model import grouplearner
 from optimizer import optimizer as op
 from optimizer import spec
@@ -28,6 +30,10 @@ def main(argv):
     parser.add_argument('--n_task', type=int, default=10, help='Number of tasks')
     parser.add_argument('--n_block', type=int, default=7, help='Number of blocks in BPERM')
     parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--cache_dir', type=str, default='', help='directory of the task dataset cache')
+    parser.add_argument('--cache_size', type=float, default=20.0, help='size limit of the task cache (GB)')
+    parser.add_argument('--n_worker', type=int, default=0, help='processes for task generation (0, 1: in process); tasks depend only on --seed')
+    parser.add_argument('--streaming', action='store_true', help='build tasks on demand with prefetch of the next task (view families are built eagerly)')
     parser.add_argument('--save_path', type=str, default='results/', help='save models')
 
     args = parser.parse_args()
@@ -45,6 +51,12 @@ def main(argv):
     model_dir = 'HMTrain'
 
     run_config = tf.estimator.RunConfig(model_dir=model_dir, save_checkpoints_steps=int(60000/n_batch))
+    if args.cache_dir:
+        set_of_dataset.SetOfDataSet.cache = cache.TaskCache(args.cache_dir, int(args.cache_size * 2**30))
+    set_of_dataset.SetOfDataSet.n_worker = args.n_worker
+    set_of_dataset.SetOfDataSet.seed = seed
+    set_of_dataset.SetOfDataSet.streaming = args.streaming
+
     DataClass = getattr(importlib.import_module('dataset.set_of_dataset'), 'SetOfRand' + args.data)
 
     # generate sequence dataset
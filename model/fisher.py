@@ -0,0 +1,107 @@
+import os
+import numpy as np
+
+
+def quantize(array, dtype='int8', scale='tensor'):
+    # per-tensor or per-row (first axis) scales; values keep their relative precision inside each scale group
+    array = np.asarray(array, dtype=np.float32)
+    if dtype == 'float32':
+        return array, None
+
+    if scale == 'row' and array.ndim > 1:
+        magnitude = np.max(np.abs(array), axis=tuple(range(1, array.ndim)), keepdims=True)
+    elif scale in ('row', 'tensor'):
+        magnitude = np.max(np.abs(array), keepdims=True) if array.size else np.ones([1] * array.ndim)
+    else:
+        raise ValueError('unknown scale: ' + scale)
+    magnitude = np.where(magnitude > 0, magnitude, 1.0).astype(np.float32)
+
+    if dtype == 'int8':
+        return np.rint(array / magnitude * 127).astype(np.int8), magnitude / 127
+    if dtype == 'float16':
+        return (array / magnitude).astype(np.float16), magnitude
+
+    raise ValueError('unknown dtype: ' + dtype)
+
+
+def dequantize(values, scale):
+    if scale is None:
+        return np.asarray(values, dtype=np.float32)
+
+    return values.astype(np.float32) * scale
+
+
+def compact_format(dtype, scale):
+    # QEWC with float32 would store the fisher uncompressed and train exactly like OEWC, so it falls back to int8 rows
+    if dtype == 'float32':
+        return 'int8', 'row'
+
+    return dtype, scale
+
+
+def top_k_size(size, budget):
+    # number of entries a budget fraction keeps, at least one
+    return min(size, max(1, int(np.ceil(budget * size))))
+
+
+def top_k(array, budget):
+    # flat indices and values of the largest budget fraction of the entries
+    flat = np.asarray(array, dtype=np.float32).reshape(-1)
+    k = top_k_size(flat.size, budget)
+    index = np.sort(np.argpartition(flat, flat.size - k)[flat.size - k:]).astype(np.int32)
+
+    return index, flat[index]
+
+
+class FisherArchive(object):
+    # finished tasks' curvature state on disk, one directory per task, read back as memmaps by task index
+    def __init__(self, archive_dir, fisher_dtype='float32', fisher_scale='tensor'):
+        self.archive_dir = archive_dir
+        self.fisher_dtype = fisher_dtype
+        self.fisher_scale = fisher_scale
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+    def task_dir(self, i_task):
+        return os.path.join(self.archive_dir, 'task' + str(i_task))
+
+    @staticmethod
+    def file_name(kind, name):
+        return kind + '-' + name.replace('/', '.') + '.npy'
+
+    def save(self, i_task, name, arrays):
+        path = self.task_dir(i_task)
+        os.makedirs(path, exist_ok=True)
+        for kind, array in arrays.items():
+            scale = None
+            if kind == 'fisher':
+                array, scale = quantize(array, self.fisher_dtype, self.fisher_scale)
+            self.write(os.path.join(path, self.file_name(kind, name)), array)
+            scale_path = os.path.join(path, self.file_name(kind + '_scale', name))
+            if scale is not None:
+                self.write(scale_path, scale)
+            elif os.path.exists(scale_path):
+                os.remove(scale_path)
+
+    @staticmethod
+    def write(target, array):
+        tmp = target + '.tmp.npy'
+        np.save(tmp, np.asarray(array))
+        os.replace(tmp, target)
+
+    def load(self, i_task, kind, names):
+        path = self.task_dir(i_task)
+        arrays = []
+        for name in names:
+            array = np.load(os.path.join(path, self.file_name(kind, name)), mmap_mode='r')
+            scale_path = os.path.join(path, self.file_name(kind + '_scale', name))
+            if os.path.exists(scale_path):
+                array = dequantize(array, np.load(scale_path))
+            arrays.append(array)
+
+        return arrays
+
+    def tasks(self):
+        return sorted(int(d[4:]) for d in os.listdir(self.archive_dir) if d.startswith('task'))
+
+    def __contains__(self, i_task):
+        return os.path.isdir(self.task_dir(i_task))
@@ -1,4 +1,8 @@
+import os
+from model import imm
 from model import learner
+from model import resident
+from model import tensor_store
 import numpy as np
 
 
@@ -13,13 +17,17 @@ class GroupLearner(object):
     def train_and_evaluate(self):
         pass
 
-    def evaluate(self, i):
+    def evaluate(self, i, run_config=None):
+        run_config = self.run_config if run_config is None else run_config
+        eval_learner = learner.MultiTaskEvalEstimatorLearner(self.set_of_dataset.list[:i + 1], self.learning_specs[i],
+                                                             run_config)
+        result = eval_learner.evaluate()
         for j in range(i + 1):
-            self.learning_specs[j].n_batch = 10
-            eval_learner = learner.SingleEstimatorLearner(self.set_of_dataset.list[j], self.learning_specs[j],
-                                                          self.run_config)
-            result = eval_learner.evaluate()
-            self.eval_matrix[i, j] = result['accuracy']
+            self.eval_matrix[i, j] = result['accuracy' + str(j)]
+
+    def finish(self, i):
+        # task i is neither trained on nor fed again by this learner; a streamed task may free its training data
+        self.set_of_dataset.release(i)
 
 
 class GroupSingleLearner(GroupLearner):
@@ -33,6 +41,7 @@ class GroupSingleLearner(GroupLearner):
             single_learner.train()
 
             self.evaluate(i)
+            self.finish(i)
 
         return self.eval_matrix
 
@@ -45,19 +54,23 @@ class GroupOEWCLearner(GroupLearner):
         base_dataset = self.set_of_dataset.list[0]
         base_learner = learner.BaseEstimatorLearner(base_dataset, self.learning_specs[0], self.run_config)
         base_learner.train()
+        base_learner.estimate_fisher()
 
         result = base_learner.evaluate()
         self.eval_matrix[0, 0] = result['accuracy']
 
     def train_and_evaluate(self):
         self.base_train()
+        self.finish(0)
 
         for i in range(1, self.n_task):
             dataset = self.set_of_dataset.list[i]
             single_learner = learner.OEWCEstimatorLearner(dataset, self.learning_specs[i], self.run_config)
             single_learner.train()
+            single_learner.estimate_fisher(i_task=i)
 
             self.evaluate(i)
+            self.finish(i)
 
         return self.eval_matrix
 
@@ -76,6 +89,7 @@ class GroupCenterEWCLearner(GroupLearner):
 
     def train_and_evaluate(self):
         self.base_train()
+        self.finish(0)
 
         for i in range(1, self.n_task):
             dataset = self.set_of_dataset.list[i]
@@ -83,6 +97,7 @@ class GroupCenterEWCLearner(GroupLearner):
             single_learner.train()
 
             self.evaluate(i)
+            self.finish(i)
 
         return self.eval_matrix
 
@@ -95,23 +110,56 @@ class GroupEWCLearner(GroupOEWCLearner):
         base_dataset = self.set_of_dataset.list[0]
         base_learner = learner.FullBaseEstimatorLearner(base_dataset, self.learning_specs[0], self.run_config, 0)
         base_learner.train()
+        base_learner.estimate_fisher()
 
         result = base_learner.evaluate()
         self.eval_matrix[0, 0] = result['accuracy']
 
     def train_and_evaluate(self):
         self.base_train()
+        self.finish(0)
 
         for i in range(1, self.n_task):
             dataset = self.set_of_dataset.list[i]
-            single_learner = learner.OEWCEstimatorLearner(dataset, self.learning_specs[i], self.run_config, i)
+            single_learner = learner.EWCEstimatorLearner(dataset, self.learning_specs[i], self.run_config, i)
             single_learner.train()
+            single_learner.estimate_fisher()
 
             self.evaluate(i)
+            self.finish(i)
 
         return self.eval_matrix
 
 
+class GroupResidentSingleLearner(GroupLearner):
+    penalty = False
+
+    def __init__(self, set_of_dataset, learning_specs, n_task, run_config):
+        super(GroupResidentSingleLearner, self).__init__(set_of_dataset, learning_specs, n_task, run_config)
+
+    def train_and_evaluate(self):
+        resident_learner = resident.ResidentLearner(self.set_of_dataset.list[0], self.learning_specs[0], self.penalty)
+
+        for i in range(self.n_task):
+            resident_learner.train(self.set_of_dataset.list[i])
+
+            for j in range(i + 1):
+                self.eval_matrix[i, j] = resident_learner.evaluate(self.set_of_dataset.list[j])['accuracy']
+            self.finish(i)
+
+        resident_learner.save(self.run_config.model_dir)
+        resident_learner.close()
+
+        return self.eval_matrix
+
+
+class GroupResidentOEWCLearner(GroupResidentSingleLearner):
+    penalty = True
+
+    def __init__(self, set_of_dataset, learning_specs, n_task, run_config):
+        super(GroupResidentOEWCLearner, self).__init__(set_of_dataset, learning_specs, n_task, run_config)
+
+
 class GroupFedSGDLearner(GroupLearner):
     def __init__(self, set_of_dataset, learning_specs, n_task, run_config):
         super(GroupFedSGDLearner, self).__init__(set_of_dataset, learning_specs, n_task, run_config)
@@ -127,6 +175,7 @@ class GroupFedSGDLearner(GroupLearner):
         base_dataset = self.set_of_dataset.list[0]
         base_learner = learner.BaseEstimatorLearner(base_dataset, self.learning_specs[0], self.run_config)
         base_learner.train()
+        base_learner.estimate_fisher()
 
     def train_and_evaluate(self):
         for i in range(self.n_fed_task):
@@ -151,6 +200,7 @@ class GroupFedOEWCLearner(GroupFedSGDLearner):
             dataset = self.set_of_dataset.list[i_task]
             single_learner = learner.OEWCEstimatorLearner(dataset, self.learning_specs[0], self.run_config)
             single_learner.train()
+            single_learner.estimate_fisher(i_task=i)
 
         self.evaluate(self.n_task - 1)
 
@@ -169,6 +219,7 @@ class GroupFedQEWCLearner(GroupFedSGDLearner):
             dataset = self.set_of_dataset.list[i_task]
             single_learner = learner.QEWCEstimatorLearner(dataset, self.learning_specs[0], self.run_config)
             single_learner.train()
+            single_learner.estimate_fisher(i_task=i)
 
         self.evaluate(self.n_task - 1)
 
@@ -186,15 +237,15 @@ class GroupInDepLearner(GroupLearner):
             single_learner.train()
 
             self.evaluate(i)
+            self.finish(i)
 
         return self.eval_matrix
 
     def evaluate(self, i):
-        self.learning_specs[i].n_batch = 10
-        eval_learner = learner.SingleEstimatorLearner(self.set_of_dataset.list[i], self.learning_specs[i],
-                                                      self.run_config)
+        eval_learner = learner.MultiTaskEvalEstimatorLearner(self.set_of_dataset.list[i:i + 1], self.learning_specs[i],
+                                                             self.run_config)
         result = eval_learner.evaluate()
-        self.eval_matrix[i, i] = result['accuracy']
+        self.eval_matrix[i, i] = result['accuracy0']
 
 
 class GroupMultiLearner(GroupInDepLearner):
@@ -207,6 +258,7 @@ class GroupMultiLearner(GroupInDepLearner):
 
         for i in range(self.n_task):
             self.evaluate(i)
+            self.finish(i)
 
         return self.eval_matrix
 
@@ -214,17 +266,31 @@ class GroupMultiLearner(GroupInDepLearner):
 class GroupIMMLearner(GroupLearner):
     def __init__(self, set_of_dataset, learning_specs, n_task, run_config):
         super(GroupIMMLearner, self).__init__(set_of_dataset, learning_specs, n_task, run_config)
+        self.merger = imm.IMMMerger()
+        self.imm_config = run_config.replace(model_dir=os.path.join(run_config.model_dir, 'imm'))
 
     def train_and_evaluate(self):
         for i in range(self.n_task):
             dataset = self.set_of_dataset.list[i]
             imm_learner = learner.IMMEstimatorLearner(dataset, self.learning_specs[i], self.run_config, i)
             imm_learner.train()
+            imm_learner.estimate_fisher(i_task=i)
 
-            self.evaluate(i)
+            self.merge(i)
+            self.evaluate(i, self.imm_config)
+            self.finish(i)
 
         return self.eval_matrix
 
+    def merge(self, i):
+        # the merged weights are written once as a checkpoint of their own that every evaluation of row i restores
+        tensors = tensor_store.store.tensors(self.run_config.model_dir)
+        self.merger.update(tensors)
+        merged = dict(tensors)
+        merged.update(self.merger.merge(self.learning_specs[i].imm_mode))
+        path = os.path.join(self.imm_config.model_dir, 'model.ckpt-' + str(tensors['global_step']))
+        tensor_store.write_checkpoint(path, merged)
+
 
 class GroupHMTrainLearner(GroupLearner):
     def __init__(self, set_of_dataset, learning_specs, n_task, run_config, meta_learning_spec):
@@ -244,6 +310,7 @@ class GroupHMTrainLearner(GroupLearner):
             meta_learner = learner.MetaAlphaTrainEstimatorLearner(joint_dataset, self.learning_specs[i],
                                                                   self.meta_learning_spec, self.run_config, i)
             meta_learner.train()
+            self.finish(i)
 
 
 class GroupHMTestLearner(GroupLearner):
@@ -262,6 +329,7 @@ class GroupHMTestLearner(GroupLearner):
 
     def train_and_evaluate(self):
         self.base_train()
+        self.finish(0)
 
         for i in range(1, self.n_task):
             dataset = self.set_of_dataset.list[i]
@@ -269,5 +337,6 @@ class GroupHMTestLearner(GroupLearner):
             meta_learner.train()
 
             self.evaluate(i)
+            self.finish(i)
 
         return self.eval_matrix
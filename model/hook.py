@@ -1,5 +1,6 @@
 import tensorflow as tf
 import numpy as np
+from model import fisher as fisher_format
 
 
 class GradientHook(tf.estimator.SessionRunHook):
@@ -39,6 +40,41 @@ class SquareAccumulationGradientHook(GradientHook):
                                         'condition': self.assign_condition})
 
 
+class FusedSquareAccumulationGradientHook(tf.estimator.SessionRunHook):
+    # one conditional op accumulates every layer; the host only sees fisher norms at the reporting boundary
+    def __init__(self, grads_and_vars, n_batch, n_train):
+        self.grads_and_vars = grads_and_vars
+        self.names = [v.name[5:-2] for _, v in grads_and_vars]
+        self.n_batch = n_batch
+        self.n_train = n_train
+        self.period = int(n_train / self.n_batch)
+
+        self.global_step = tf.compat.v1.train.get_global_step()
+
+    def begin(self):
+        self.sum_gradients = [tf.Variable(tf.zeros_like(g), name=('fisher/' + name))
+                              for (g, _), name in zip(self.grads_and_vars, self.names)]
+        self.assign_condition = tf.greater_equal(self.global_step % self.period, self.period - self.n_batch)
+
+        def accumulate():
+            return tf.group([s.assign_add(tf.math.square(g)) for s, (g, _) in zip(self.sum_gradients, self.grads_and_vars)])
+
+        self.accumulate_op = tf.cond(self.assign_condition, accumulate, tf.no_op)
+        self.norms = [tf.norm(s) for s in self.sum_gradients]
+
+    def after_create_session(self, session, coord):
+        self.step = session.run(self.global_step)
+
+    def before_run(self, run_context):
+        return tf.estimator.SessionRunArgs(self.accumulate_op)
+
+    def after_run(self, run_context, run_values):
+        if (self.step + self.n_batch) % self.period == 0:
+            for name, norm in zip(self.names, run_context.session.run(self.norms)):
+                print(name, ': fisher', norm)
+        self.step += 1
+
+
 class CenterSquareAccumulationGradientHook(SquareAccumulationGradientHook):
     def __init__(self, grad_and_var, n_batch, n_train):
         super(CenterSquareAccumulationGradientHook, self).__init__(grad_and_var, n_batch, n_train)
@@ -69,24 +105,40 @@ class CenterSquareAccumulationGradientHook(SquareAccumulationGradientHook):
 
 
 class SequentialSquareAccumulationGradientHook(SquareAccumulationGradientHook):
-    def __init__(self, grad_and_var, n_batch, n_train, n_task, i_task):
+    # only the current task's fisher and theta live in the graph; a finished task is written to the archive.
+    # with estimated=True the fisher is left to the post-task estimation pass and only theta is accumulated
+    def __init__(self, grad_and_var, n_batch, n_train, n_task, i_task, archive=None, estimated=False):
         super(SequentialSquareAccumulationGradientHook, self).__init__(grad_and_var, n_batch, n_train)
         self.n_task = n_task
         self.i_task = i_task
-        self.fisher = []
-        self.theta = []
-
-        for i in range(self.n_task):
-            self.fisher.append(tf.Variable(tf.zeros_like(self.gradients), name=('fisher' + str(i) + '/' + self.name)))
-            self.theta.append(tf.Variable(tf.zeros_like(self.gradients), name=('theta' + str(i) + '/' + self.name)))
+        self.archive = archive
+        self.estimated = estimated
+        self.fisher = state_variable(self.variable, 'fisher')
+        self.theta = state_variable(self.variable, 'theta')
+        self.task = state_variable(self.variable, 'fisher_task', [], tf.int64)
 
     def begin(self):
         self.condition = tf.greater_equal(self.global_step % self.period, self.period - self.n_batch)
         self.assigned_fisher = tf.where(self.condition, tf.math.square(self.gradients), tf.zeros_like(self.gradients))
-        self.assigned_theta = tf.where(self.condition, tf.math.square(self.gradients), tf.zeros_like(self.gradients))
-
-        self.fisher[self.i_task] = tf.assign_add(self.fisher[self.i_task], self.assigned_fisher)
-        self.theta[self.i_task] = tf.assign_add(self.theta[self.i_task], self.assigned_theta)
+        # theta is the anchor of the penalty: the weights as of the last step of the accumulation window
+        self.assigned_theta = tf.where(self.condition, self.variable, self.theta)
+
+        self.sum_fisher = tf.identity(self.fisher) if self.estimated else self.fisher.assign_add(self.assigned_fisher)
+        self.sum_theta = self.theta.assign(self.assigned_theta)
+        self.reset_op = tf.group(self.fisher.assign(tf.zeros_like(self.fisher)),
+                                 self.theta.assign(tf.zeros_like(self.theta)),
+                                 self.task.assign(self.i_task))
+
+    def after_create_session(self, session, coord):
+        # restored accumulators belong to the previous task, which the archive already holds
+        if session.run(self.task) != self.i_task:
+            session.run(self.reset_op)
+
+    def end(self, session):
+        if self.archive is not None:
+            fisher, theta = session.run([self.fisher, self.theta])
+            arrays = {'theta': theta} if self.estimated else {'fisher': fisher, 'theta': theta}
+            self.archive.save(self.i_task, self.name, arrays)
 
     def save_fisher_component(self, results):
         if (results['global_step'] + self.n_batch) % self.period == 0:
@@ -94,6 +146,80 @@ class SequentialSquareAccumulationGradientHook(SquareAccumulationGradientHook):
             print(self.name, ': theta', np.linalg.norm(results['theta']))
 
     def before_run(self, run_context):
-        return tf.estimator.SessionRunArgs({'fisher': self.fisher,
-                                        'theta': self.theta,
-                                        'global_step': self.global_step})
+        return tf.estimator.SessionRunArgs({'fisher': self.sum_fisher,
+                                            'theta': self.sum_theta,
+                                            'global_step': self.global_step})
+
+
+class IteratorInitializerHook(tf.estimator.SessionRunHook):
+    def __init__(self):
+        self.initializer = None
+        self.feed_dict = {}
+
+    def after_create_session(self, session, coord):
+        session.run(self.initializer, feed_dict=self.feed_dict)
+
+
+def state_variable(variable, prefix, shape=None, dtype=tf.float32):
+    # non-trainable per-weight state, created once per graph and shared by model_fn creators and hooks
+    name = variable.name[5:-2]
+    shape = variable.shape if shape is None else shape
+    with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope(), reuse=tf.compat.v1.AUTO_REUSE):
+        return tf.compat.v1.get_variable(prefix + '/' + name, shape=shape, dtype=dtype,
+                                         initializer=tf.zeros_initializer(), trainable=False)
+
+
+def consolidated_variables(variable):
+    # per-weight state of the consolidated EWC penalty
+    return {'precision': state_variable(variable, 'ewc_precision'),
+            'mean': state_variable(variable, 'ewc_mean'),
+            'offset': state_variable(variable, 'ewc_offset', []),
+            'count': state_variable(variable, 'ewc_count', [], tf.int64)}
+
+
+class ConsolidatedSquareAccumulationGradientHook(SequentialSquareAccumulationGradientHook):
+    # sum_i mse(w, theta_i, fisher_i) == sum(precision * (w - mean)^2) + offset, folded once per task boundary
+    def __init__(self, grad_and_var, n_batch, n_train, i_task, archive=None, estimated=False, budget=1.0):
+        super(ConsolidatedSquareAccumulationGradientHook, self).__init__(grad_and_var, n_batch, n_train, None, i_task,
+                                                                         archive, estimated)
+        self.budget = budget
+        self.state = consolidated_variables(self.variable)
+
+    def begin(self):
+        super(ConsolidatedSquareAccumulationGradientHook, self).begin()
+        self.fold_op = self.fold()
+
+    def fold(self):
+        fisher, theta = self.fisher, self.theta
+        precision, mean, offset = self.state['precision'], self.state['mean'], self.state['offset']
+        if self.budget < 1.0:
+            fisher = self.top_k(fisher)
+
+        # mean_squared_error weights by fisher and divides by its non-zero count
+        n_present = tf.maximum(tf.cast(tf.math.count_nonzero(fisher), tf.float32), 1.0)
+        weight = fisher / n_present
+        new_precision = precision + weight
+        new_mean = tf.math.divide_no_nan(precision * mean + weight * theta, new_precision)
+        constant = offset + tf.reduce_sum(precision * tf.math.square(mean)) + tf.reduce_sum(weight * tf.math.square(theta))
+        new_offset = constant - tf.reduce_sum(new_precision * tf.math.square(new_mean))
+
+        with tf.control_dependencies([new_precision, new_mean, new_offset]):
+            assign_ops = [precision.assign(new_precision), mean.assign(new_mean), offset.assign(new_offset)]
+        with tf.control_dependencies(assign_ops):
+            count_op = self.state['count'].assign(self.i_task)
+
+        return count_op
+
+    def top_k(self, fisher):
+        # the entries fisher.top_k keeps for the sparse penalty; the rest of the task's fisher is not folded
+        size = int(np.prod(self.variable.shape))
+        k = fisher_format.top_k_size(size, self.budget)
+        index = tf.math.top_k(tf.reshape(fisher, [-1]), k).indices
+        mask = tf.scatter_nd(index[:, None], tf.ones([k]), [size])
+
+        return fisher * tf.reshape(mask, tf.shape(fisher))
+
+    def after_create_session(self, session, coord):
+        if session.run(self.state['count']) < self.i_task:
+            session.run(self.fold_op)
+        super(ConsolidatedSquareAccumulationGradientHook, self).after_create_session(session, coord)
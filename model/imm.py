@@ -0,0 +1,47 @@
+import numpy as np
+
+
+class IMMMerger(object):
+    # running moments of the weights each task ends with: the count, sum(theta), sum(F) and sum(F * theta).
+    # mean-IMM is sum(theta) / n and mode-IMM is sum(F * theta) / sum(F); merges are cached until the next task
+    def __init__(self):
+        self.n_task = 0
+        self.moments = {}
+        self.cumulative_fisher = {}
+        self.merged = {}
+
+    def update(self, tensors):
+        # fisher/ in the checkpoint sums over every task so far; the finished task's share is the increase
+        for key in tensors:
+            if not key.startswith('main/'):
+                continue
+            name = key[5:]
+            theta = tensors[key].astype(np.float64)
+            cumulative = tensors.get('fisher/' + name, np.zeros_like(theta)).astype(np.float64)
+            task_fisher = cumulative - self.cumulative_fisher.get(name, 0.0)
+            self.cumulative_fisher[name] = cumulative
+
+            moment = self.moments.setdefault(name, {'theta': 0.0, 'fisher': 0.0, 'fisher_theta': 0.0})
+            moment['theta'] = moment['theta'] + theta
+            moment['fisher'] = moment['fisher'] + task_fisher
+            moment['fisher_theta'] = moment['fisher_theta'] + task_fisher * theta
+
+        self.n_task += 1
+        self.merged = {}
+
+    def merge(self, mode='mean'):
+        if mode not in self.merged:
+            if mode not in ('mean', 'mode'):
+                raise ValueError('unknown IMM mode: ' + mode)
+
+            weights = {}
+            for name, moment in self.moments.items():
+                mean = moment['theta'] / max(self.n_task, 1)
+                if mode == 'mode':
+                    # weights no task has any fisher for fall back to the mean
+                    fisher = moment['fisher']
+                    mean = np.where(fisher > 0, moment['fisher_theta'] / np.where(fisher > 0, fisher, 1.0), mean)
+                weights['main/' + name] = mean.astype(np.float32)
+            self.merged[mode] = weights
+
+        return self.merged[mode]
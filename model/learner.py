@@ -1,7 +1,134 @@
 import abc
+import os
+import time
 import tensorflow as tf
 import numpy as np
 from model import model_fn
+from model import hook
+from model import net
+from model import fisher
+from model import tensor_store
+
+
+eval_batch_sizes = {}
+
+
+def autotune_eval_batch(x_test, d_in, max_bytes, candidates=(100, 250, 500, 1000, 2500, 5000, 10000), n_step=5):
+    key = (x_test.dtype.str, d_in, x_test.shape[0], max_bytes)
+    if key in eval_batch_sizes:
+        return eval_batch_sizes[key]
+
+    with tf.Graph().as_default():
+        x = tf.compat.v1.placeholder(tf.as_dtype(x_test.dtype), (None,) + x_test.shape[1:])
+        features = tf.reshape(EstimatorLearner.normalize(x), [-1, d_in])
+        model = net.Main(d_in).build()
+        predictions = tf.argmax(model(features), axis=1)
+
+        # input batch, normalized copy and every layer's activations of one example
+        n_unit = sum(int(w.shape[-1]) for w in model.weights if len(w.shape) == 2)
+        example_bytes = x_test.dtype.itemsize * d_in + 4 * (d_in + n_unit)
+
+        best, best_rate = candidates[0], 0.0
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            for n_batch in candidates:
+                if n_batch > x_test.shape[0] or n_batch * example_bytes > max_bytes:
+                    break
+
+                feed_dict = {x: x_test[:n_batch]}
+                sess.run(predictions, feed_dict=feed_dict)
+                start = time.time()
+                for _ in range(n_step):
+                    sess.run(predictions, feed_dict=feed_dict)
+                rate = n_batch * n_step / (time.time() - start)
+
+                if rate > best_rate:
+                    best, best_rate = n_batch, rate
+
+    print('eval batch autotune:', best, '(', int(best_rate), 'examples/s )')
+    eval_batch_sizes[key] = best
+
+    return best
+
+
+class FisherEstimator(object):
+    # dedicated pass at a task boundary: diagonal empirical fisher from per-example gradients of a sample budget
+    def __init__(self, learning_spec):
+        self.learning_spec = learning_spec
+        self.d_in = learning_spec.optimizer_spec.d_in
+        self.n_sample = learning_spec.fisher_samples
+        self.n_batch = learning_spec.fisher_batch
+
+    def estimate(self, dataset, model_dir, mode='add', archive=None, i_task=0):
+        start = time.time()
+        tensors = tensor_store.store.tensors(model_dir)
+        x_train, y_train = dataset.train_data()
+        n_sample = min(self.n_sample, y_train.shape[0])
+        # a different sample per run and per task, reproducible from the run seed
+        rng = np.random.RandomState([self.learning_spec.seed, i_task])
+        rows = np.sort(rng.choice(y_train.shape[0], n_sample, replace=False))
+
+        with tf.Graph().as_default():
+            x = tf.compat.v1.placeholder(tf.as_dtype(x_train.dtype), (None,) + x_train.shape[1:])
+            y = tf.compat.v1.placeholder(tf.as_dtype(y_train.dtype), [None])
+            names, batch_fisher = self.build(dataset, tensors, x, y)
+
+            sums = [0.0] * len(names)
+            with tf.compat.v1.Session() as sess:
+                for begin in range(0, n_sample, self.n_batch):
+                    index = rows[begin:begin + self.n_batch]
+                    values = sess.run(batch_fisher, feed_dict={x: x_train[index], y: y_train[index]})
+                    sums = [s + v for s, v in zip(sums, values)]
+
+        estimates = dict(zip(names, [s / max(n_sample, 1) for s in sums]))
+        self.write(model_dir, tensors, estimates, mode)
+        if archive is not None:
+            for name, f in estimates.items():
+                archive.save(i_task, name, {'fisher': f})
+
+        elapsed = time.time() - start
+        print('fisher estimation:', n_sample, 'samples,', round(1000 * elapsed / max(n_sample, 1), 3), 's per 1k samples')
+
+        return estimates
+
+    def build(self, dataset, tensors, x, y):
+        features, labels = dataset.transform(x, y)
+        a = tf.reshape(EstimatorLearner.normalize(features), [-1, self.d_in])
+
+        # dense layers unrolled with the restored weights, keeping each layer's input and pre-activation
+        layers = net.Main(self.d_in).build().layers
+        assert all(isinstance(layer, tf.keras.layers.Dense) and layer.use_bias for layer in layers), \
+            'fisher estimation unrolls dense layers only'
+        inputs, outputs, names = [], [], []
+        for layer in layers:
+            kernel = tensors[layer.name + '/kernel']
+            bias = tensors[layer.name + '/bias']
+            z = tf.matmul(a, kernel) + bias
+            inputs.append(a)
+            outputs.append(z)
+            names += [layer.name[5:] + '/kernel', layer.name[5:] + '/bias']
+            a = layer.activation(z)
+
+        losses = tf.nn.softmax_cross_entropy_with_logits(labels=tf.one_hot(labels, 10), logits=outputs[-1])
+        deltas = tf.compat.v1.gradients(tf.reduce_sum(losses), outputs)
+
+        # per-example kernel gradient is outer(a_i, delta_i), so its square summed over the batch is (a^2)^T delta^2
+        batch_fisher = []
+        for a, delta in zip(inputs, deltas):
+            batch_fisher.append(tf.matmul(tf.math.square(a), tf.math.square(delta), transpose_a=True))
+            batch_fisher.append(tf.reduce_sum(tf.math.square(delta), axis=0))
+
+        return names, batch_fisher
+
+    @staticmethod
+    def write(model_dir, tensors, estimates, mode):
+        # rewrite the latest checkpoint with its fisher/ entries replaced ('assign') or accumulated ('add')
+        values = dict(tensors)
+        for name, f in estimates.items():
+            key = 'fisher/' + name
+            values[key] = f.astype(np.float32) + (values[key] if mode == 'add' and key in values else 0)
+
+        tensor_store.write_checkpoint(tf.train.latest_checkpoint(model_dir), values)
 
 
 class NNLearner(object):
@@ -23,24 +150,76 @@ class EstimatorLearner(NNLearner):
         super(EstimatorLearner, self).__init__(dataset, learning_spec)
         tf.compat.v1.disable_eager_execution()
         self.estimator = tf.estimator.Estimator(model_fn=self.model_fn, config=run_config)
+        self.input_hook = hook.IteratorInitializerHook()
 
     def train(self):
-        self.estimator.train(input_fn=self.train_input_fn)
+        self.estimator.train(input_fn=self.input_fn(self.train_input_fn), hooks=[self.input_hook])
 
     def evaluate(self):
-        return self.estimator.evaluate(input_fn=self.eval_input_fn)
+        return self.estimator.evaluate(input_fn=self.input_fn(self.eval_input_fn), hooks=[self.input_hook])
+
+    def input_fn(self, dataset_fn):
+        def fn():
+            self.input_hook.feed_dict = {}
+            iterator = tf.compat.v1.data.make_initializable_iterator(dataset_fn())
+            self.input_hook.initializer = iterator.initializer
+
+            return iterator.get_next()
+
+        return fn
+
+    def feed(self, arrays):
+        # arrays are fed once at iterator initialization instead of being embedded in the graph as constants
+        placeholders = tuple(tf.compat.v1.placeholder(tf.as_dtype(a.dtype), a.shape) for a in arrays)
+        self.input_hook.feed_dict.update(zip(placeholders, arrays))
+
+        return placeholders
+
+    def tensor_slices(self, arrays):
+        return tf.data.Dataset.from_tensor_slices(self.feed(arrays))
+
+    def pipeline(self, tf_data, n_batch, n_epoch=1, n_shuffle=0):
+        if self.learning_spec.cache:
+            tf_data = tf_data.cache()
+        if n_shuffle > 0:
+            tf_data = tf_data.shuffle(n_shuffle, reshuffle_each_iteration=True)
+        tf_data = tf_data.repeat(n_epoch).batch(n_batch)
+        tf_data = tf_data.map(self.preprocess, num_parallel_calls=self.learning_spec.n_parallel)
+
+        return tf_data.prefetch(self.learning_spec.n_prefetch)
 
     def train_input_fn(self):
-        tf_train = tf.data.Dataset.from_tensor_slices((self.dataset.x_train, self.dataset.y_train))
-        tf_train = tf_train.repeat(self.learning_spec.n_epoch).batch(self.learning_spec.n_batch)
+        tf_train = self.tensor_slices(self.dataset.train_data())
 
-        return tf_train
+        return self.pipeline(tf_train, self.learning_spec.n_batch, self.learning_spec.n_epoch)
 
     def eval_input_fn(self):
-        tf_eval = tf.data.Dataset.from_tensor_slices((self.dataset.x_test, self.dataset.y_test))
-        tf_eval = tf_eval.batch(10)
+        tf_eval = self.tensor_slices(self.dataset.test_data())
+
+        return self.pipeline(tf_eval, self.eval_batch(self.dataset.test_data()[0]))
+
+    def eval_batch(self, x_test):
+        if self.learning_spec.n_eval_batch == -1:
+            return autotune_eval_batch(x_test, self.learning_spec.optimizer_spec.d_in,
+                                       self.learning_spec.eval_memory * 2 ** 20)
+
+        return self.learning_spec.n_eval_batch
+
+    def preprocess(self, x, y):
+        x, y = self.dataset.transform(x, y)
+
+        return self.normalize(x), y
 
-        return tf_eval
+    @staticmethod
+    def normalize(x):
+        if x.dtype == tf.uint8:
+            x = tf.cast(x, tf.float32) / 255.0
+
+        return x
+
+    def estimate_fisher(self, mode='add', i_task=0):
+        if self.learning_spec.fisher_samples > 0:
+            FisherEstimator(self.learning_spec).estimate(self.dataset, self.estimator.model_dir, mode, i_task=i_task)
 
     def model_fn(self, features, labels, mode):
         pass
@@ -69,11 +248,21 @@ class SGDEstimatorLearner(SingleEstimatorLearner):
         self.n_train = self.learning_spec.n_train
 
     def train_input_fn(self):
+        x_train, y_train = self.dataset.train_data()
+        x_fed, y_fed = self.feed((x_train[:self.n_fed_batch], y_train[:self.n_fed_batch]))
+
+        # bootstrap and shuffle over row indices; rows are gathered per batch from the fed slice
         shuffle_map = np.random.choice(self.n_fed_batch, self.n_train, replace=True)
-        tf_train = tf.data.Dataset.from_tensor_slices((self.dataset.x_train[shuffle_map], self.dataset.y_train[shuffle_map]))
-        tf_train = tf_train.shuffle(self.learning_spec.n_train, reshuffle_each_iteration=True).repeat(self.learning_spec.n_epoch).batch(self.learning_spec.n_batch)
+        tf_index = self.tensor_slices((shuffle_map,))
+        tf_index = tf_index.shuffle(self.n_train, reshuffle_each_iteration=True)
+        tf_index = tf_index.repeat(self.learning_spec.n_epoch).batch(self.learning_spec.n_batch)
+
+        def gather(index):
+            return self.preprocess(tf.gather(x_fed, index), tf.gather(y_fed, index))
 
-        return tf_train
+        tf_train = tf_index.map(gather, num_parallel_calls=self.learning_spec.n_parallel)
+
+        return tf_train.prefetch(self.learning_spec.n_prefetch)
 
 
 class OEWCEstimatorLearner(EstimatorLearner):
@@ -107,30 +296,57 @@ class CenterEWCEstimatorLearner(OEWCEstimatorLearner):
         return model_fn_creator.create()
 
 
-class EWCEstimatorLearner(OEWCEstimatorLearner):
-    def __init__(self, dataset, learning_spec, run_config, i_task):
-        super(EWCEstimatorLearner, self).__init__(dataset, learning_spec, run_config)
-        self.i_task = i_task
+class MultiEstimatorLearner(EstimatorLearner):
+    def __init__(self, dataset, learning_spec, run_config):
+        super(MultiEstimatorLearner, self).__init__(dataset, learning_spec, run_config)
+
+    def train_input_fn(self):
+        seed = np.random.randint(2 ** 31)
+
+        def batches():
+            return self.dataset.batches(self.learning_spec.n_batch, self.learning_spec.n_epoch, seed)
+
+        tf_train = tf.data.Dataset.from_generator(batches, (tf.as_dtype(self.dataset.x_dtype), tf.as_dtype(self.dataset.y_dtype)),
+                                                  (tf.TensorShape((None,) + self.dataset.x_shape), tf.TensorShape([None])))
+        tf_train = tf_train.map(self.preprocess, num_parallel_calls=self.learning_spec.n_parallel)
+
+        return tf_train.prefetch(self.learning_spec.n_prefetch)
 
     def model_fn(self, features, labels, mode):
-        model_fn_creator = model_fn.EWCModelFNCreator(features, labels, mode, self.learning_spec, self.i_task)
+        model_fn_creator = model_fn.SingleModelFNCreator(features, labels, mode, self.learning_spec)
 
         return model_fn_creator.create()
 
 
-class MultiEstimatorLearner(EstimatorLearner):
-    def __init__(self, dataset, learning_spec, run_config):
-        super(MultiEstimatorLearner, self).__init__(dataset, learning_spec, run_config)
-        self.x_max = dataset.x_train.shape[0]
+class MultiTaskEvalEstimatorLearner(EstimatorLearner):
+    # evaluates the current weights on a list of tasks with a single restore; results hold 'accuracy<j>' per task
+    def __init__(self, datasets, learning_spec, run_config):
+        super(MultiTaskEvalEstimatorLearner, self).__init__(datasets, learning_spec, run_config)
 
-    def train_input_fn(self):
-        tf_train = tf.data.Dataset.from_tensor_slices((self.dataset.x_train, self.dataset.y_train))
-        tf_train = tf_train.shuffle(self.x_max*self.learning_spec.n_task).repeat(self.learning_spec.n_epoch).batch(self.learning_spec.n_batch)
+    def eval_input_fn(self):
+        fed = {}
+        tf_eval = None
+        for j, dataset in enumerate(self.dataset):
+            x_test, y_test = dataset.test_data()
+            if id(x_test) not in fed:
+                fed[id(x_test)] = self.feed((x_test, y_test))
+
+            tf_task = tf.data.Dataset.from_tensor_slices(fed[id(x_test)]).batch(self.eval_batch(x_test))
+            tf_task = tf_task.map(self.tagger(j), num_parallel_calls=self.learning_spec.n_parallel)
+            tf_eval = tf_task if tf_eval is None else tf_eval.concatenate(tf_task)
+
+        return tf_eval.prefetch(self.learning_spec.n_prefetch)
+
+    def tagger(self, j):
+        def fn(x, y):
+            x, y = self.dataset[j].transform(x, y)
+
+            return {'x': self.normalize(x), 'task': tf.fill(tf.shape(y), j)}, y
 
-        return tf_train
+        return fn
 
     def model_fn(self, features, labels, mode):
-        model_fn_creator = model_fn.SingleModelFNCreator(features, labels, mode, self.learning_spec)
+        model_fn_creator = model_fn.MultiTaskEvalModelFNCreator(features, labels, mode, self.learning_spec, len(self.dataset))
 
         return model_fn_creator.create()
 
@@ -177,6 +393,25 @@ class FullBaseEstimatorLearner(BaseEstimatorLearner):
 
         return model_fn_creator.create()
 
+    def estimate_fisher(self, mode='assign'):
+        # the consolidated hooks fold the current task's fisher at the next boundary and archive it per task
+        if self.learning_spec.fisher_samples > 0:
+            archive = fisher.FisherArchive(os.path.join(self.learning_spec.model_dir, 'fisher_archive'),
+                                           self.learning_spec.fisher_dtype, self.learning_spec.fisher_scale)
+            FisherEstimator(self.learning_spec).estimate(self.dataset, self.estimator.model_dir, mode, archive,
+                                                         self.i_task)
+
+
+class EWCEstimatorLearner(FullBaseEstimatorLearner):
+    # trains against the consolidated penalty and keeps the base learner's per-task fisher estimation and archive
+    def __init__(self, dataset, learning_spec, run_config, i_task):
+        super(EWCEstimatorLearner, self).__init__(dataset, learning_spec, run_config, i_task)
+
+    def model_fn(self, features, labels, mode):
+        model_fn_creator = model_fn.EWCModelFNCreator(features, labels, mode, self.learning_spec, self.i_task)
+
+        return model_fn_creator.create()
+
 
 class MetaAlphaBaseEstimatorLearner(EstimatorLearner):
     def __init__(self, dataset, learning_spec, run_config, i_task):
@@ -227,30 +462,28 @@ class MetaAlphaTrainEstimatorLearner(EstimatorLearner):
         return model_fn_creator.create()
 
     def train_input_fn(self):
-        tf_train0 = tf.data.Dataset.from_tensor_slices((self.dataset[0].x_train, self.dataset[0].y_train))
-        tf_train1 = tf.data.Dataset.from_tensor_slices((self.dataset[1].x_train, self.dataset[1].y_train))
-
-        dataset_tuple = (tf_train0, tf_train1)
-        tf_comb_train = tf.data.Dataset.zip(dataset_tuple)
-        tf_flat_train = tf_comb_train.flat_map(self.map_fn)
-        total_tuple = (tf_flat_train,) + dataset_tuple
-
-        tf_train = tf.data.Dataset.zip(total_tuple)
-        tf_train = tf_train.map(self.unfold_tuple)
+        train0, train1 = self.dataset[0].train_data(), self.dataset[1].train_data()
+        x0, y0 = self.feed(train0)
+        x1, y1 = (x0, y0) if train1[0] is train0[0] else self.feed(train1)
+        n_pair = min(train0[1].shape[0], train1[1].shape[0])
+
+        def triples(k):
+            # element k: joint stream interleaves (task0[k//2], task1[k//2]); current and next are task0[k], task1[k]
+            n = tf.shape(k)[0]
+            half = k // 2
+            select = tf.range(n) + n * tf.cast(k % 2, tf.int32)
+
+            f2, l2 = self.dataset[0].transform(tf.gather(x0, k), tf.gather(y0, k))
+            f3, l3 = self.dataset[1].transform(tf.gather(x1, k), tf.gather(y1, k))
+            j0, m0 = self.dataset[0].transform(tf.gather(x0, half), tf.gather(y0, half))
+            j1, m1 = self.dataset[1].transform(tf.gather(x1, half), tf.gather(y1, half))
+            f1 = tf.gather(tf.concat([j0, j1], axis=0), select)
+            l1 = tf.gather(tf.concat([m0, m1], axis=0), select)
+
+            return (self.normalize(f1), self.normalize(f2), self.normalize(f3)), (l1, l2, l3)
+
+        tf_train = tf.data.Dataset.range(n_pair)
         tf_train = tf_train.repeat(self.learning_spec.n_epoch).batch(2 * self.learning_spec.n_batch)
+        tf_train = tf_train.map(triples, num_parallel_calls=self.learning_spec.n_parallel)
 
-        return tf_train
-
-    def unfold_tuple(self, *x):
-        t1, t2, t3 = x
-
-        f1, l1 = t1
-        f2, l2 = t2
-        f3, l3 = t3
-
-        return (f1, f2, f3), (l1, l2, l3)
-
-    def map_fn(self, *z):
-        x, y = zip(*z)
-
-        return tf.data.Dataset.from_tensor_slices((tf.stack(x), tf.stack(y)))
+        return tf_train.prefetch(self.learning_spec.n_prefetch)
@@ -1,11 +1,63 @@
 import tensorflow as tf
 import abc
+import os
 from optimizer import gradient_computer as gc
+from optimizer import optimizer as op
 from model import net
 from model import hook
+from model import tensor_store
+from model import fisher
 import numpy as np
 
 
+def dequantize(values, scale):
+    if scale is None:
+        return tf.constant(values)
+
+    return tf.cast(tf.constant(values), tf.float32) * tf.constant(scale)
+
+
+def penalty_terms(w, v, f, learning_spec, dtype='float32', scale='tensor'):
+    # with fisher_budget < 1 only the top entries are kept as index/value pairs and the penalty gathers just those
+    index = None
+    if learning_spec.fisher_budget < 1.0:
+        index, f = fisher.top_k(f, learning_spec.fisher_budget)
+        v = np.asarray(v).reshape(-1)[index]
+        w = tf.gather(tf.reshape(w, [-1]), index)
+        scale = 'tensor'
+
+    values, scales = fisher.quantize(f, dtype, scale)
+
+    return w, v, dequantize(values, scales), index
+
+
+def ewc_penalty(w, v, f, learning_spec, dtype='float32', scale='tensor', gradient=False):
+    # sum(f * (w - v)^2); with gradient=True also its closed-form gradient 2 * f * (w - v), built from the same
+    # constants. A sparse penalty scatters its gradient entries back into the weight's shape
+    terms, v, f, index = penalty_terms(w, v, f, learning_spec, dtype, scale)
+    diff = terms - v
+    penalty = tf.math.reduce_sum(f * tf.math.square(diff))
+    if not gradient:
+        return penalty
+
+    penalty_gradient = 2.0 * f * diff
+    if index is not None:
+        penalty_gradient = tf.reshape(tf.scatter_nd(index[:, None], penalty_gradient, [int(np.prod(w.shape))]),
+                                      w.shape)
+
+    return penalty, penalty_gradient
+
+
+def sum_penalties(penalties, gradient=False):
+    # per-layer penalties, or (penalty, gradient) pairs, into the total penalty and the list of gradients
+    if not gradient:
+        return tf.add_n(penalties)
+
+    values, gradients = zip(*penalties)
+
+    return tf.add_n(list(values)), list(gradients)
+
+
 class ModelFNCreator(object):
     def __init__(self, features, labels, mode, learning_spec):
         self.learning_spec = learning_spec
@@ -32,13 +84,9 @@ class ModelFNCreator(object):
         pass
 
     def load_tensors(self, checkpoint, prefix):
-        pre_grads = []
-        for i, w in enumerate(self.model.weights):
-            name = w.name[5:-2]
-            pre_grad = tf.train.load_variable(checkpoint, prefix + '/' + name)
-            pre_grads.append(pre_grad)
+        names = [prefix + '/' + w.name[5:-2] for w in self.model.weights]
 
-        return pre_grads
+        return tensor_store.store.load(checkpoint, names)
 
     def evaluate(self, loss):
         accuracy = tf.keras.metrics.Accuracy()
@@ -49,12 +97,15 @@ class ModelFNCreator(object):
         return tf.estimator.EstimatorSpec(self.mode, loss=loss, eval_metric_ops=metrics)
 
     def compute_curvature(self, grads_and_vars):
-        gradient_hook = []
-        for grad_and_var in grads_and_vars:
-            n_total = self.learning_spec.n_batch * self.learning_spec.n_fed_step
-            gradient_hook.append(hook.SquareAccumulationGradientHook(grad_and_var, self.learning_spec.n_batch, n_total))
+        if self.learning_spec.fisher_samples > 0:
+            # filled by the post-task estimation pass; kept in the graph so every checkpoint carries it forward
+            for _, v in grads_and_vars:
+                hook.state_variable(v, 'fisher')
+            return []
 
-        return gradient_hook
+        n_total = self.learning_spec.n_batch * self.learning_spec.n_fed_step
+
+        return [hook.FusedSquareAccumulationGradientHook(grads_and_vars, self.learning_spec.n_batch, n_total)]
 
     def global_step_increase(self, grads_and_vars):
         global_step_increase_op = self.global_step.assign_add(1)
@@ -63,6 +114,37 @@ class ModelFNCreator(object):
 
         return train_op
 
+    def penalized_gradients(self, add_penalty):
+        # 'autodiff' differentiates through the penalty graph; 'analytic' and 'fused_sgd' take the penalty and its
+        # closed-form gradient from one build, add the gradient to the data-loss gradient and only summarize the penalty
+        if self.learning_spec.penalty_gradient == 'autodiff':
+            self.loss = self.loss + self.alpha * add_penalty(False)
+            return gc.ScopeGradientComputer(self.opt, self.loss, self.model.weights).compute()
+
+        penalty, penalty_gradients = add_penalty(True)
+        tf.summary.scalar(name='losses/ewc_penalty', data=self.alpha * penalty)
+        self.penalty_gradients = [self.alpha * g for g in penalty_gradients]
+
+        if self.learning_spec.penalty_gradient == 'analytic':
+            gradient_computer = gc.PenaltyGradientComputer(self.opt, self.loss, self.model.weights,
+                                                           self.penalty_gradients)
+        else:
+            gradient_computer = gc.ScopeGradientComputer(self.opt, self.loss, self.model.weights)
+
+        return gradient_computer.compute()
+
+    def penalized_step(self, grads_and_vars):
+        if self.learning_spec.penalty_gradient != 'fused_sgd':
+            return self.global_step_increase(grads_and_vars)
+
+        # plain SGD with the penalty gradient folded into the update: w -= lr * (g + alpha * 2F(w - v))
+        if not isinstance(self.optimizer_spec.optimizer, op.SGDOptimizer):
+            raise ValueError('fused_sgd penalty gradient needs the SGD optimizer')
+        learning_rate = self.optimizer_spec.optimizer.learning_rate
+        with tf.control_dependencies([self.global_step.assign_add(1)]):
+            return tf.group([w.assign_sub(learning_rate * (g + p))
+                             for (g, w), p in zip(grads_and_vars, self.penalty_gradients)])
+
 
 class SingleModelFNCreator(ModelFNCreator):
     def __init__(self, features, labels, mode, learning_spec):
@@ -80,6 +162,36 @@ class SingleModelFNCreator(ModelFNCreator):
         return tf.estimator.EstimatorSpec(self.mode, loss=self.loss, train_op=train_op)
 
 
+class MultiTaskEvalModelFNCreator(ModelFNCreator):
+    # forward pass only: no gradients, regularizers or Fisher loads, so a restore touches just the main weights
+    def __init__(self, features, labels, mode, learning_spec, n_task):
+        super(MultiTaskEvalModelFNCreator, self).__init__(features['x'], labels, mode, learning_spec)
+        self.task = features['task']
+        self.n_task = n_task
+
+    def create(self):
+        correct = tf.cast(tf.equal(self.predictions, self.labels), tf.float32)
+        batch_correct = tf.math.unsorted_segment_sum(correct, self.task, self.n_task)
+        batch_count = tf.math.unsorted_segment_sum(tf.ones_like(correct), self.task, self.n_task)
+
+        sum_correct = self.metric_variable('sum_correct')
+        sum_count = self.metric_variable('sum_count')
+        update_op = tf.group(sum_correct.assign_add(batch_correct), sum_count.assign_add(batch_count))
+        accuracy = sum_correct / tf.maximum(sum_count, 1.0)
+
+        metrics = {}
+        for j in range(self.n_task):
+            metrics['accuracy' + str(j)] = (accuracy[j], update_op)
+
+        return tf.estimator.EstimatorSpec(self.mode, loss=self.loss, eval_metric_ops=metrics)
+
+    def metric_variable(self, name):
+        return tf.compat.v1.get_variable('eval/' + name, shape=[self.n_task], initializer=tf.zeros_initializer(),
+                                         trainable=False,
+                                         collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES,
+                                                      tf.compat.v1.GraphKeys.METRIC_VARIABLES])
+
+
 class BaseModelFNCreator(ModelFNCreator):
     def __init__(self, features, labels, mode, learning_spec):
         super(BaseModelFNCreator, self).__init__(features, labels, mode, learning_spec)
@@ -111,30 +223,11 @@ class CenterBaseModelFNCreator(BaseModelFNCreator):
         return gradient_hook
 
 
-class IMMModelFNCreator(CenterBaseModelFNCreator):
+class IMMModelFNCreator(BaseModelFNCreator):
+    # trains like the base learner; the merge happens once per task boundary in imm.IMMMerger, not in the eval graph
     def __init__(self, features, labels, mode, learning_spec, i_task):
-        super(IMMModelFNCreator, self).__init__(features, labels, mode, learning_spec, i_task)
-
-    def evaluate(self, loss):
-        v_center = self.load_tensors(self.learning_spec.model_dir, 'center')
-        v_mean = self.average(v_center)
-
-        self.model.set_weight(v_mean)
-        self.logits = self.model(self.features)
-        self.predictions = tf.argmax(self.logits, axis=1)
-
-        accuracy = tf.metrics.accuracy(self.labels, self.predictions)
-        metrics = {'accuracy': accuracy}
-        tf.summary.scalar(name='accuracy', tensor=accuracy)
-
-        return tf.estimator.EstimatorSpec(self.mode, loss=loss, eval_metric_ops=metrics)
-
-    def average(self, v):
-        average_v = []
-        for item in v:
-            average_v.append(item / (self.i_task+2))
-
-        return average_v
+        super(IMMModelFNCreator, self).__init__(features, labels, mode, learning_spec)
+        self.i_task = i_task
 
 
 class FullBaseModelFNCreator(BaseModelFNCreator):
@@ -142,14 +235,17 @@ class FullBaseModelFNCreator(BaseModelFNCreator):
         super(FullBaseModelFNCreator, self).__init__(features, labels, mode, learning_spec)
         self.learning_spec = learning_spec
         self.i_task = i_task
+        self.archive = fisher.FisherArchive(os.path.join(learning_spec.model_dir, 'fisher_archive'),
+                                            learning_spec.fisher_dtype, learning_spec.fisher_scale)
 
     def compute_curvature(self, grads_and_vars):
         gradient_hook = []
         for i, grad_and_var in enumerate(grads_and_vars):
-            gradient_hook.append(hook.SequentialSquareAccumulationGradientHook(grad_and_var, self.learning_spec.n_batch,
-                                                                               self.learning_spec.n_train,
-                                                                               self.learning_spec.n_task,
-                                                                               self.i_task))
+            gradient_hook.append(hook.ConsolidatedSquareAccumulationGradientHook(grad_and_var, self.learning_spec.n_batch,
+                                                                                 self.learning_spec.n_train,
+                                                                                 self.i_task, self.archive,
+                                                                                 self.learning_spec.fisher_samples > 0,
+                                                                                 self.learning_spec.fisher_budget))
 
         return gradient_hook
 
@@ -163,56 +259,51 @@ class OEWCModelFNCreator(ModelFNCreator):
         g_pre = self.load_tensors(self.learning_spec.model_dir, 'fisher')
         v_pre = self.load_tensors(self.learning_spec.model_dir, 'main')
 
-        self.loss = self.loss + self.alpha * self.add_ewc_loss(self.model.weights, v_pre, g_pre)
-        gradient_computer = gc.ScopeGradientComputer(self.opt, self.loss, self.model.weights)
-        grads_and_vars = gradient_computer.compute()
+        grads_and_vars = self.penalized_gradients(
+            lambda gradient: self.add_ewc_loss(self.model.weights, v_pre, g_pre, gradient))
 
         if self.mode == tf.estimator.ModeKeys.EVAL:
             return self.evaluate(self.loss)
 
-        train_op = self.global_step_increase(grads_and_vars)
+        train_op = self.penalized_step(grads_and_vars)
 
         gradient_hook = self.compute_curvature(grads_and_vars)
 
         return tf.estimator.EstimatorSpec(self.mode, loss=self.loss, train_op=train_op, training_hooks=gradient_hook)
 
-    def add_ewc_loss(self, v_cur, v_pre, g_pre):
-        ewc_loss = 0
-        for w, v, f in zip(v_cur, v_pre, g_pre):
-            ewc_loss = ewc_loss + tf.math.reduce_sum(f * tf.math.square(w-v))
-
-        return ewc_loss
+    def add_ewc_loss(self, v_cur, v_pre, g_pre, gradient=False):
+        return sum_penalties([ewc_penalty(w, v, f, self.learning_spec, gradient=gradient)
+                              for w, v, f in zip(v_cur, v_pre, g_pre)], gradient)
 
 
 class QuantizedEWCModelFNCreator(ModelFNCreator):
     def __init__(self, features, labels, mode, learning_spec):
         super(QuantizedEWCModelFNCreator, self).__init__(features, labels, mode, learning_spec)
         self.alpha = learning_spec.alpha
+        self.fisher_dtype, self.fisher_scale = fisher.compact_format(learning_spec.fisher_dtype,
+                                                                     learning_spec.fisher_scale)
 
     def create(self):
         g_pre = self.load_tensors(self.learning_spec.model_dir, 'fisher')
         v_pre = self.load_tensors(self.learning_spec.model_dir, 'main')
 
-        self.loss = self.loss + self.alpha * self.add_ewc_loss(self.model.weights, v_pre, g_pre)
-        gradient_computer = gc.ScopeGradientComputer(self.opt, self.loss, self.model.weights)
-        grads_and_vars = gradient_computer.compute()
+        grads_and_vars = self.penalized_gradients(
+            lambda gradient: self.add_ewc_loss(self.model.weights, v_pre, g_pre, gradient))
 
         if self.mode == tf.estimator.ModeKeys.EVAL:
             return self.evaluate(self.loss)
 
-        train_op = self.global_step_increase(grads_and_vars)
+        train_op = self.penalized_step(grads_and_vars)
 
         gradient_hook = self.compute_curvature(grads_and_vars)
 
         return tf.estimator.EstimatorSpec(self.mode, loss=self.loss, train_op=train_op, training_hooks=gradient_hook)
 
-    def add_ewc_loss(self, v_cur, v_pre, g_pre):
-        ewc_loss = 0
-        for w, v, f in zip(v_cur, v_pre, g_pre):
-            quantized_f = np.round(f, 1)
-            ewc_loss = ewc_loss + tf.math.reduce_sum(quantized_f*tf.math.square(w-v))
-
-        return ewc_loss
+    def add_ewc_loss(self, v_cur, v_pre, g_pre, gradient=False):
+        # the graph holds the compact fisher (int8 or float16 plus scales) and expands it inside the penalty;
+        # the checkpoint's fisher/ variables stay float32, only these constants are compact
+        return sum_penalties([ewc_penalty(w, v, f, self.learning_spec, self.fisher_dtype, self.fisher_scale, gradient)
+                              for w, v, f in zip(v_cur, v_pre, g_pre)], gradient)
 
 
 class CenterEWCModelFNCreator(CenterBaseModelFNCreator):
@@ -252,58 +343,49 @@ class EWCModelFNCreator(FullBaseModelFNCreator):
         self.alpha = learning_spec.alpha
 
     def create(self):
-        self.loss = self.loss + self.alpha * self.add_ewc_loss(self.model.weights)
-        gradient_computer = gc.ScopeGradientComputer(self.opt, self.loss, self.model.weights)
-        grads_and_vars = gradient_computer.compute()
+        grads_and_vars = self.penalized_gradients(lambda gradient: self.add_ewc_loss(self.model.weights, gradient))
 
         if self.mode == tf.estimator.ModeKeys.EVAL:
             return self.evaluate(self.loss)
 
-        train_op = self.global_step_increase(grads_and_vars)
+        train_op = self.penalized_step(grads_and_vars)
 
         gradient_hook = self.compute_curvature(grads_and_vars)
 
         return tf.estimator.EstimatorSpec(self.mode, loss=self.loss, train_op=train_op, training_hooks=gradient_hook)
 
-    def add_ewc_loss(self, v_cur):
-        ewc_loss = 0
-        for i in range(self.i_task):
-            g_pre = self.load_tensors(self.learning_spec.model_dir, 'fisher'+str(i))
-            v_pre = self.load_tensors(self.learning_spec.model_dir, 'theta'+str(i))
-            for w, v, f in zip(v_cur, v_pre, g_pre):
-                ewc_loss = ewc_loss + tf.losses.mean_squared_error(w, v, f)
+    def add_ewc_loss(self, v_cur, gradient=False):
+        # all previous tasks' penalties folded into one quadratic per weight: the cost does not grow with i_task
+        ewc_loss, gradients = 0, []
+        for w in v_cur:
+            state = hook.consolidated_variables(w)
+            diff = w - state['mean']
+            ewc_loss = ewc_loss + tf.math.reduce_sum(state['precision'] * tf.math.square(diff)) + state['offset']
+            gradients.append(2.0 * state['precision'] * diff)
 
-        return ewc_loss
+        return (ewc_loss, gradients) if gradient else ewc_loss
 
 
 class QEWCModelFNCreator(EWCModelFNCreator):
     def __init__(self, features, labels, mode, learning_spec, i_task):
-        super(EWCModelFNCreator, self).__init__(features, labels, mode, learning_spec, i_task)
+        super(QEWCModelFNCreator, self).__init__(features, labels, mode, learning_spec, i_task)
+        # only the per-task fisher archive is compact; the consolidated state in the checkpoint stays float32
+        self.archive = fisher.FisherArchive(os.path.join(learning_spec.model_dir, 'fisher_archive'),
+                                            *fisher.compact_format(learning_spec.fisher_dtype,
+                                                                   learning_spec.fisher_scale))
 
     def create(self):
-        self.loss = self.loss + self.alpha * self.add_ewc_loss(self.model.weights)
-        gradient_computer = gc.ScopeGradientComputer(self.opt, self.loss, self.model.weights)
-        grads_and_vars = gradient_computer.compute()
+        grads_and_vars = self.penalized_gradients(lambda gradient: self.add_ewc_loss(self.model.weights, gradient))
 
         if self.mode == tf.estimator.ModeKeys.EVAL:
             return self.evaluate(self.loss)
 
-        train_op = self.global_step_increase(grads_and_vars)
+        train_op = self.penalized_step(grads_and_vars)
 
         gradient_hook = self.compute_curvature(grads_and_vars)
 
         return tf.estimator.EstimatorSpec(self.mode, loss=self.loss, train_op=train_op, training_hooks=gradient_hook)
 
-    def add_ewc_loss(self, v_cur):
-        ewc_loss = 0
-        for i in range(self.i_task):
-            g_pre = self.load_tensors(self.learning_spec.model_dir, 'fisher'+str(i))
-            v_pre = self.load_tensors(self.learning_spec.model_dir, 'theta'+str(i))
-            for w, v, f in zip(v_cur, v_pre, g_pre):
-                ewc_loss = ewc_loss + tf.losses.mean_squared_error(w, v, f)
-
-        return ewc_loss
-
 
 class MetaModelFNCreator(ModelFNCreator):
     def __init__(self, features, labels, mode, learning_spec):
@@ -331,13 +413,30 @@ class MetaModelFNCreator(ModelFNCreator):
         return meta_loss
 
     @staticmethod
-    def layer_to_flat(grads):
-        grad_list = []
-        for grad in grads:
-            flat_grad = tf.reshape(grad, [-1, 1])
-            grad_list.append(flat_grad)
+    def meta_loss_gradients(g_pre, v_cur, v_pre):
+        # add_meta_loss is sum_l mse_l^2 with mse_l = sum(f * (w - v)^2) / nonzero(f),
+        # so its gradient is 4 * mse_l * f * (w - v) / nonzero(f) layer by layer
+        gradients = []
+        for (w, f, v) in zip(v_cur, g_pre, v_pre):
+            n_present = tf.maximum(tf.cast(tf.math.count_nonzero(f), tf.float32), 1.0)
+            diff = w - v
+            mse = tf.reduce_sum(f * tf.math.square(diff)) / n_present
+            gradients.append(4.0 * mse * f * diff / n_present)
+
+        return gradients
 
-        return tf.concat(grad_list, axis=0)
+    def previous_tensors(self, model_dir):
+        # the previous task's fisher and weights are constant for the whole task: one graph constant per layer,
+        # shared by the meta-features, meta-labels and meta loss
+        g_pre = [tf.constant(f) for f in self.load_tensors(model_dir, 'fisher')]
+        v_pre = [tf.constant(v) for v in self.load_tensors(model_dir, 'main')]
+
+        return g_pre, v_pre
+
+    @staticmethod
+    def layer_dot(xs, ys):
+        # <x, y> over all parameters as a sum of per-layer partial reductions, without building flat vectors
+        return tf.add_n([tf.reduce_sum(x * y) for x, y in zip(xs, ys)])
 
     @staticmethod
     def flat_to_layer(grads, cur_vars):
@@ -363,13 +462,10 @@ class MetaAlphaModelFNCreator(MetaModelFNCreator):
         self.i_task = i_task
 
     def combine_meta_features(self, g_cur, g_pre, v_pre, v_cur):
-        flat_g_pre = self.layer_to_flat(g_pre)
-        flat_g_cur = self.layer_to_flat(g_cur)
-        flat_v_pre = self.layer_to_flat(v_pre)
-        flat_v_cur = self.layer_to_flat(v_cur)
+        v_diff = [c - p for c, p in zip(v_cur, v_pre)]
 
-        combine_list = (tf.reduce_sum(tf.matmul(flat_g_pre, flat_g_cur, transpose_a=True)),
-                        tf.norm(flat_v_cur-flat_v_pre))
+        combine_list = (self.layer_dot(g_pre, g_cur),
+                        tf.sqrt(self.layer_dot(v_diff, v_diff)))
 
         return tf.reshape(tf.stack(combine_list), shape=[1, -1])
 
@@ -385,8 +481,7 @@ class MetaAlphaTestModelFNCreator(MetaAlphaModelFNCreator):
         grads_and_vars = gradient_computer.compute()
 
         g_cur, v_cur = zip(*grads_and_vars)
-        g_pre = self.load_tensors(self.learning_spec.model_dir, 'fisher')
-        v_pre = self.load_tensors(self.learning_spec.model_dir, 'main')
+        g_pre, v_pre = self.previous_tensors(self.learning_spec.model_dir)
 
         meta_batch = self.combine_meta_features(g_cur, g_pre, v_pre, v_cur)
         meta_output = self.meta_model(meta_batch)
@@ -396,10 +491,19 @@ class MetaAlphaTestModelFNCreator(MetaAlphaModelFNCreator):
         self.total_loss = self.loss + self.alpha * meta_output * self.add_meta_loss(g_pre, self.model.weights, v_pre)
         tf.summary.scalar(name='losses/total_loss', tensor=tf.reshape(self.total_loss, shape=[]))
 
-        total_gradient_computer = gc.ScopeGradientComputer(self.opt, self.total_loss, self.model.weights)
-        total_grads_and_vars = total_gradient_computer.compute()
-
-        train_op = self.global_step_increase(grads_and_vars)
+        if self.learning_spec.meta_update == 'single_pass':
+            # the hypernetwork output scales the closed-form meta-loss gradient and the regularized gradient is
+            # applied; no second differentiation of total_loss, and no term through the meta-features
+            coefficient = self.alpha * tf.reshape(tf.stop_gradient(meta_output), [])
+            meta_grads = self.meta_loss_gradients(g_pre, v_cur, v_pre)
+            total_grads_and_vars = [(g + coefficient * m, v) for g, m, v in zip(g_cur, meta_grads, v_cur)]
+            train_op = self.global_step_increase(total_grads_and_vars)
+        elif self.learning_spec.meta_update == 'baseline':
+            total_gradient_computer = gc.ScopeGradientComputer(self.opt, self.total_loss, self.model.weights)
+            total_grads_and_vars = total_gradient_computer.compute()
+            train_op = self.global_step_increase(grads_and_vars)
+        else:
+            raise ValueError('unknown meta_update: ' + self.learning_spec.meta_update)
 
         gradient_hook = self.compute_curvature(total_grads_and_vars)
 
@@ -417,25 +521,13 @@ class MetaAlphaTrainModelFNCreator(MetaAlphaModelFNCreator):
 
         super(MetaAlphaTrainModelFNCreator, self).__init__(self.cur_features, self.cur_labels, mode, learning_spec, i_task)
 
-        # joint gradient
-        self.joint_logits = self.model(self.joint_features)
-        self.joint_one_hot_labels = tf.one_hot(self.joint_labels, 10)
-        self.joint_loss = tf.losses.softmax_cross_entropy(self.joint_one_hot_labels, self.joint_logits)
-
     def create(self):
-        # current gradient
+        g_cur, g_joint = self.current_and_joint_gradients()
+        v_cur = self.model.weights
+        grads_and_vars = list(zip(g_cur, v_cur))
         tf.summary.scalar(name='losses/cur_loss', tensor=self.loss)
-        gradient_computer = gc.ScopeGradientComputer(self.opt, self.loss, self.model.weights)
-        grads_and_vars = gradient_computer.compute()
 
-        g_cur, v_cur = zip(*grads_and_vars)
-
-        joint_gradient_computer = gc.ScopeGradientComputer(self.opt, self.joint_loss, self.model.weights)
-        joint_grads_and_vars = joint_gradient_computer.compute()
-
-        g_joint, _ = zip(*joint_grads_and_vars)
-        g_pre = self.load_tensors(self.meta_learning_spec.model_dir, 'fisher')
-        v_pre = self.load_tensors(self.meta_learning_spec.model_dir, 'main')
+        g_pre, v_pre = self.previous_tensors(self.meta_learning_spec.model_dir)
 
         meta_batch = self.combine_meta_features(g_cur, g_pre, v_cur, v_pre)
         meta_label = self.make_meta_labels(g_cur, g_joint, v_cur, v_pre, g_pre)
@@ -449,29 +541,56 @@ class MetaAlphaTrainModelFNCreator(MetaAlphaModelFNCreator):
         meta_gradient_computer = gc.ScopeGradientComputer(self.meta_opt, meta_loss, self.meta_model.weights)
         meta_grads_and_vars = meta_gradient_computer.compute()
 
-        ops = self.global_step_increase_meta(meta_grads_and_vars)
+        ops = self.global_step_increase_meta(grads_and_vars, meta_grads_and_vars)
 
         gradient_hook = self.compute_curvature(grads_and_vars)
 
         return tf.estimator.EstimatorSpec(self.mode, loss=self.loss, train_op=tf.group(ops),
                                           training_hooks=gradient_hook)
 
-    def make_meta_labels(self, g_cur, g_joint, v_cur, v_pre, g_pre):
-        flat_g_pre = self.layer_to_flat(g_pre)
-        flat_g_cur = self.layer_to_flat(g_cur)
-        flat_v_pre = self.layer_to_flat(v_pre)
-        flat_v_cur = self.layer_to_flat(v_cur)
+    def current_and_joint_gradients(self):
+        if all(isinstance(layer, tf.keras.layers.Dense) and layer.use_bias for layer in self.model.layers):
+            return self.stacked_gradients()
+
+        # layers that stacked_gradients cannot unroll: one backward pass per batch
+        joint_logits = self.model(self.joint_features)
+        self.joint_loss = self.cce(tf.one_hot(self.joint_labels, 10), joint_logits)
+        g_cur, _ = zip(*gc.ScopeGradientComputer(self.opt, self.loss, self.model.weights).compute())
+        g_joint, _ = zip(*gc.ScopeGradientComputer(self.opt, self.joint_loss, self.model.weights).compute())
+
+        return list(g_cur), list(g_joint)
+
+    def stacked_gradients(self):
+        # the dense layers are unrolled over [current; joint] so the deltas are backpropagated once; a layer's
+        # kernel gradient is a^T delta, and splitting its rows gives the two batches' gradients separately
+        n_cur = tf.shape(self.cur_features)[0]
+        a = tf.concat([self.cur_features, self.joint_features], axis=0)
+        inputs, outputs = [], []
+        for layer in self.model.layers:
+            z = tf.matmul(a, layer.kernel) + layer.bias
+            inputs.append(a)
+            outputs.append(z)
+            a = layer.activation(z)
+
+        self.loss = self.cce(self.one_hot_labels, a[:n_cur])
+        self.joint_loss = self.cce(tf.one_hot(self.joint_labels, 10), a[n_cur:])
+        deltas = tf.compat.v1.gradients(self.loss + self.joint_loss, outputs)
+
+        g_cur, g_joint = [], []
+        for a, delta in zip(inputs, deltas):
+            for rows, grads in [(slice(None, n_cur), g_cur), (slice(n_cur, None), g_joint)]:
+                grads.append(tf.matmul(a[rows], delta[rows], transpose_a=True))
+                grads.append(tf.reduce_sum(delta[rows], axis=0))
+
+        return g_cur, g_joint
 
-        flat_g_joint = self.layer_to_flat(g_joint)
-
-        X = flat_g_joint-flat_g_cur
-        Y = tf.multiply(flat_g_pre, (flat_v_cur-flat_v_pre))
-        X2 = tf.multiply(X, X)
-        XY = tf.multiply(X, Y)
+    def make_meta_labels(self, g_cur, g_joint, v_cur, v_pre, g_pre):
+        X = [j - c for j, c in zip(g_joint, g_cur)]
+        Y = [f * (c - p) for f, c, p in zip(g_pre, v_cur, v_pre)]
 
         epsilon = 1e-3
 
-        alpha = tf.reduce_sum(X2)/(tf.reduce_sum(XY) + epsilon)
+        alpha = self.layer_dot(X, X)/(self.layer_dot(X, Y) + epsilon)
         tf.summary.scalar(name='parameter/alpha', tensor=alpha)
 
         return tf.reshape(alpha, shape=[1, -1])
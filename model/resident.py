@@ -0,0 +1,137 @@
+import os
+import tensorflow as tf
+import numpy as np
+from model import learner
+from model import net
+
+
+class ResidentLearner(object):
+    # one graph and one session for a whole task sequence: tasks are swapped by re-initializing the input
+    # iterator and weights stay in memory between tasks, so no per-task graph build, restore or warm start
+    def __init__(self, template, learning_spec, penalty=False):
+        self.learning_spec = learning_spec
+        self.d_in = learning_spec.optimizer_spec.d_in
+        self.penalty = penalty
+
+        x_train, y_train = template.train_data()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.build(x_train.dtype, x_train.shape[1:], y_train.dtype)
+            self.session = tf.compat.v1.Session(graph=self.graph)
+            self.session.run(tf.compat.v1.global_variables_initializer())
+
+    def build(self, x_dtype, x_shape, y_dtype):
+        self.x = tf.compat.v1.placeholder(tf.as_dtype(x_dtype), (None,) + x_shape)
+        self.y = tf.compat.v1.placeholder(tf.as_dtype(y_dtype), [None])
+        self.index = tf.compat.v1.placeholder(tf.int64, [self.d_in])
+        self.n_batch = tf.compat.v1.placeholder(tf.int64, [])
+        self.n_epoch = tf.compat.v1.placeholder(tf.int64, [])
+
+        tf_data = tf.data.Dataset.from_tensor_slices((self.x, self.y))
+        tf_data = tf_data.repeat(self.n_epoch).batch(self.n_batch)
+        tf_data = tf_data.map(self.preprocess, num_parallel_calls=self.learning_spec.n_parallel)
+        tf_data = tf_data.prefetch(self.learning_spec.n_prefetch)
+        self.iterator = tf.compat.v1.data.make_initializable_iterator(tf_data)
+        features, labels = self.iterator.get_next()
+
+        self.model = net.Main(self.d_in).build()
+        weights = self.model.weights
+        logits = self.model(features)
+        predictions = tf.argmax(logits, axis=1)
+        self.correct = tf.reduce_sum(tf.cast(tf.equal(predictions, labels), tf.int64))
+        self.count = tf.size(labels)
+
+        cce = tf.keras.losses.CategoricalCrossentropy(from_logits=True)
+        loss = cce(tf.one_hot(labels, 10), logits)
+
+        self.global_step = tf.compat.v1.train.get_or_create_global_step()
+        opt = self.learning_spec.optimizer_spec.optimizer.build()
+        saved = weights + [self.global_step]
+
+        accumulate = []
+        if self.penalty:
+            # online EWC: fisher sums over all tasks, pre_* hold the snapshot taken when the current task started
+            self.fisher = [self.state_variable('fisher', w) for w in weights]
+            pre_fisher = [self.state_variable('pre_fisher', w) for w in weights]
+            pre_weights = [self.state_variable('pre_main', w) for w in weights]
+            self.consolidate_op = tf.group([v.assign(w) for v, w in zip(pre_weights, weights)] +
+                                           [p.assign(f) for p, f in zip(pre_fisher, self.fisher)])
+
+            ewc_loss = 0
+            for w, v, f in zip(weights, pre_weights, pre_fisher):
+                ewc_loss = ewc_loss + tf.math.reduce_sum(f * tf.math.square(w - v))
+            loss = loss + self.learning_spec.alpha * ewc_loss
+
+            grads = opt.get_gradients(loss=loss, params=weights)
+            n_batch = self.learning_spec.n_batch
+            period = max(self.learning_spec.n_fed_step, 1)
+            condition = tf.greater_equal(tf.identity(self.global_step) % period, period - n_batch)
+            for f, g in zip(self.fisher, grads):
+                accumulate.append(f.assign_add(tf.math.square(g) * tf.cast(condition, tf.float32)))
+            saved = saved + self.fisher
+        else:
+            grads = opt.get_gradients(loss=loss, params=weights)
+
+        # tied to the gradients so the end-of-input run that stops a task does not count as a step
+        with tf.control_dependencies(accumulate + grads):
+            global_step_increase_op = self.global_step.assign_add(1)
+        with tf.control_dependencies([global_step_increase_op]):
+            self.train_op = opt.apply_gradients(list(zip(grads, weights)))
+
+        self.saver = tf.compat.v1.train.Saver(saved)
+
+    @staticmethod
+    def state_variable(prefix, w):
+        return tf.Variable(tf.zeros_like(w), trainable=False, name=prefix + '/' + w.name[5:-2])
+
+    def preprocess(self, x, y):
+        x = tf.gather(tf.reshape(x, [-1, self.d_in]), self.index, axis=-1)
+
+        return learner.EstimatorLearner.normalize(x), y
+
+    def initialize(self, dataset, arrays, n_batch, n_epoch):
+        index = dataset.pixel_index()
+        if index is None:
+            index = np.arange(self.d_in)
+
+        self.session.run(self.iterator.initializer, feed_dict={self.x: arrays[0], self.y: arrays[1],
+                                                               self.index: index,
+                                                               self.n_batch: n_batch, self.n_epoch: n_epoch})
+
+    def train(self, dataset):
+        if self.penalty:
+            self.session.run(self.consolidate_op)
+
+        self.initialize(dataset, dataset.train_data(), self.learning_spec.n_batch, self.learning_spec.n_epoch)
+        while True:
+            try:
+                self.session.run(self.train_op)
+            except tf.errors.OutOfRangeError:
+                break
+
+    def evaluate(self, dataset):
+        x_test, y_test = dataset.test_data()
+        n_eval_batch = self.learning_spec.n_eval_batch
+        if n_eval_batch == -1:
+            n_eval_batch = learner.autotune_eval_batch(x_test, self.d_in, self.learning_spec.eval_memory * 2 ** 20)
+
+        self.initialize(dataset, (x_test, y_test), n_eval_batch, 1)
+        correct, count = 0, 0
+        while True:
+            try:
+                batch_correct, batch_count = self.session.run([self.correct, self.count])
+            except tf.errors.OutOfRangeError:
+                break
+            correct += batch_correct
+            count += batch_count
+
+        return {'accuracy': correct / max(count, 1)}
+
+    def save(self, model_dir):
+        os.makedirs(model_dir, exist_ok=True)
+
+        with self.graph.as_default():
+            return self.saver.save(self.session, os.path.join(model_dir, 'model.ckpt'), global_step=self.global_step)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,51 @@
+import os
+import tensorflow as tf
+
+
+class TensorStore(object):
+    # reads each checkpoint once per process and serves its arrays to every model_fn creator;
+    # only the newest checkpoint of a model_dir is kept, so a new save invalidates the old entry
+    def __init__(self):
+        self.entries = {}
+
+    def load(self, checkpoint, names):
+        tensors = self.tensors(checkpoint)
+
+        return [tensors[name] for name in names]
+
+    def tensors(self, checkpoint):
+        path = tf.train.latest_checkpoint(checkpoint) if os.path.isdir(checkpoint) else checkpoint
+        if path is None:
+            raise ValueError('no checkpoint in ' + checkpoint)
+
+        key = (path, self.stamp(path))
+        entry = self.entries.get(checkpoint)
+        if entry is None or entry[0] != key:
+            reader = tf.train.load_checkpoint(path)
+            tensors = {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()}
+            entry = (key, tensors)
+            self.entries[checkpoint] = entry
+
+        return entry[1]
+
+    @staticmethod
+    def stamp(path):
+        index = path + '.index'
+
+        return os.path.getmtime(index) if os.path.exists(index) else None
+
+    def clear(self):
+        self.entries = {}
+
+
+store = TensorStore()
+
+
+def write_checkpoint(path, tensors):
+    # saves name -> array as a checkpoint at path and points the directory's checkpoint state at it
+    with tf.Graph().as_default():
+        variables = {name: tf.Variable(value, name=name.replace('/', '_')) for name, value in tensors.items()}
+        saver = tf.compat.v1.train.Saver(var_list=variables)
+        with tf.compat.v1.Session() as sess:
+            sess.run(tf.compat.v1.global_variables_initializer())
+            saver.save(sess, path, write_meta_graph=False)
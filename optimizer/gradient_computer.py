@@ -20,3 +20,14 @@ class ScopeGradientComputer(GradientComputer):
     def compute(self):
 
         return list(zip(self.opt.get_gradients(loss=self.loss, params=self.var_scope), self.var_scope))
+
+
+class PenaltyGradientComputer(ScopeGradientComputer):
+    def __init__(self, opt, loss, var_scope, penalty_gradients):
+        super(PenaltyGradientComputer, self).__init__(opt, loss, var_scope)
+        self.penalty_gradients = penalty_gradients
+
+    def compute(self):
+        grads = self.opt.get_gradients(loss=self.loss, params=self.var_scope)
+
+        return [(g + p, v) for g, p, v in zip(grads, self.penalty_gradients, self.var_scope)]
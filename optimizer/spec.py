@@ -5,7 +5,11 @@ class OptimizerSpec(object):
 
 
 class LearningSpec(object):
-    def __init__(self, n_epoch, n_batch, n_train, n_task, model_dir, optimizer_spec, n_fed_step, n_fed_round, alpha=1.0):
+    def __init__(self, n_epoch, n_batch, n_train, n_task, model_dir, optimizer_spec, n_fed_step, n_fed_round, alpha=1.0,
+                 n_prefetch=1, n_parallel=1, cache=False, n_eval_batch=1000, eval_memory=256,
+                 fisher_dtype='float32', fisher_scale='tensor', fisher_budget=1.0, fisher_samples=0,
+                 fisher_batch=500, penalty_gradient='autodiff', imm_mode='mean', meta_update='baseline',
+                 seed=0):
         self.n_epoch = n_epoch
         self.n_batch = n_batch
         self.alpha = alpha
@@ -16,3 +20,17 @@ class LearningSpec(object):
         self.n_train = n_train
         self.n_fed_step = n_fed_step
         self.n_fed_round = n_fed_round
+        self.n_prefetch = n_prefetch    # batches prefetched by the input pipeline (-1: autotune)
+        self.n_parallel = n_parallel    # parallel calls of the batch preprocessing map (-1: autotune)
+        self.cache = cache              # keep the fed examples in the tf.data cache across epochs
+        self.n_eval_batch = n_eval_batch    # evaluation batch size (-1: autotune on this host)
+        self.eval_memory = eval_memory      # memory cap of an autotuned evaluation batch (MB)
+        self.fisher_dtype = fisher_dtype    # stored fisher precision: float32, float16 or int8
+        self.fisher_scale = fisher_scale    # quantization scale per 'tensor' or per 'row'
+        self.fisher_budget = fisher_budget  # fraction of fisher entries kept by the sparse penalty (1: dense)
+        self.fisher_samples = fisher_samples    # examples of the post-task fisher estimation (0: accumulate while training)
+        self.fisher_batch = fisher_batch        # examples per batch of the post-task fisher estimation
+        self.penalty_gradient = penalty_gradient    # EWC penalty gradient: autodiff, analytic or fused_sgd
+        self.imm_mode = imm_mode                    # IMM merge: 'mean' or fisher-weighted 'mode'
+        self.meta_update = meta_update              # HM test step: 'baseline' or closed-form 'single_pass'
+        self.seed = seed                            # run seed; with the task index it keys the fisher sample
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+import dataset.dataset as ds
+
+
+def reference_permute_blocks(x, perm, n_grid, n_block):
+    # the previous per-sample path: cut each image into blocks and paste block k at grid position perm[k]
+    result = x.copy()
+    for s, sample in enumerate(x):
+        blocks = []
+        for i in range(n_grid):
+            for j in range(n_grid):
+                blocks.append(sample[n_block*i:n_block*(i+1), n_block*j:n_block*(j+1)])
+
+        perm_x = np.zeros(sample.shape, dtype=float)
+        for index, order in enumerate(perm):
+            i = int(order / n_grid)
+            j = order % n_grid
+            perm_x[n_block*i:n_block*(i+1), n_block*j:n_block*(j+1)] = blocks[index]
+
+        result[s] = perm_x
+
+    return result
+
+
+def reference_permute_label(y, label_perm):
+    y = y.copy()
+    for i, label in enumerate(y):
+        y[i] = label_perm[label]
+
+    return y
+
+
+def reference_index_from_label(y, label_list):
+    index_list = []
+    for label in label_list:
+        index_list.extend(np.where(label == y)[0])
+        index_list.sort()
+
+    return index_list
+
+
+@pytest.mark.parametrize('shape', [(6, 28, 28), (4, 32, 32, 3)], ids=['mnist', 'cifar'])
+@pytest.mark.parametrize('n_grid', [1, 2, 3, 4, 5, 7, 8])
+@pytest.mark.parametrize('dtype', [np.uint8, np.float32])
+def test_permute_blocks_matches_per_sample_path(shape, n_grid, dtype):
+    rng = np.random.RandomState(n_grid)
+    x = (rng.rand(*shape) * 255).astype(dtype)
+    n_block = int(shape[1] / n_grid)
+    perm = rng.permutation(n_grid * n_grid)
+
+    result = ds.permute_blocks(x, perm, n_grid, n_block)
+
+    assert result.dtype == x.dtype
+    np.testing.assert_array_equal(result, reference_permute_blocks(x, perm, n_grid, n_block))
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int64])
+def test_permute_label_matches_per_sample_path(dtype):
+    rng = np.random.RandomState(0)
+    dataset = ds.MNISTPERM.__new__(ds.MNISTPERM)
+    dataset.y_train = rng.randint(0, 10, 500).astype(dtype)
+    dataset.y_test = rng.randint(0, 10, 100).astype(dtype)
+    dataset.label_perm = rng.permutation(10)
+    y_train, y_test = dataset.y_train, dataset.y_test
+
+    dataset.permute_label()
+
+    assert dataset.y_train.dtype == dtype and dataset.y_test.dtype == dtype
+    np.testing.assert_array_equal(dataset.y_train, reference_permute_label(y_train, dataset.label_perm))
+    np.testing.assert_array_equal(dataset.y_test, reference_permute_label(y_test, dataset.label_perm))
+
+
+@pytest.mark.parametrize('label_list', [[0], [3, 1], [9, 0, 5, 2, 7]])
+def test_class_split_matches_per_label_path(label_list):
+    y = np.random.RandomState(1).randint(0, 10, 1000).astype(np.uint8)
+    dataset = ds.MNISTSPLIT.__new__(ds.MNISTSPLIT)
+    dataset.label_list = label_list
+
+    np.testing.assert_array_equal(dataset.obtain_index__from_label(y), reference_index_from_label(y, label_list))
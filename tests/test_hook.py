@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from model import fisher
+from model import hook
+
+
+def fold(f, theta, budget):
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.compat.v1.train.create_global_step()
+        with tf.compat.v1.variable_scope('main'):
+            variable = tf.compat.v1.get_variable('w', initializer=np.zeros_like(f))
+        consolidated = hook.ConsolidatedSquareAccumulationGradientHook((tf.zeros_like(variable), variable), 4, 16, 1,
+                                                                       budget=budget)
+        fold_op = consolidated.fold()
+        with tf.compat.v1.Session() as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+            session.run([consolidated.fisher.assign(f), consolidated.theta.assign(theta)])
+            session.run(fold_op)
+            return session.run(consolidated.state['precision'])
+
+
+@pytest.mark.parametrize('budget', [0.1, 0.5])
+def test_fold_keeps_the_sparse_penalty_entries(budget):
+    rng = np.random.RandomState(0)
+    f = rng.rand(8, 5).astype(np.float32)
+    theta = rng.randn(8, 5).astype(np.float32)
+
+    precision = fold(f, theta, budget).reshape(-1)
+    index, values = fisher.top_k(f, budget)
+
+    assert np.array_equal(np.flatnonzero(precision), index)
+    np.testing.assert_allclose(precision[index], values / len(index), rtol=1e-6)
+
+
+def test_fold_is_dense_without_budget():
+    rng = np.random.RandomState(1)
+    f = rng.rand(8, 5).astype(np.float32)
+
+    np.testing.assert_allclose(fold(f, np.zeros_like(f), 1.0), f / f.size, rtol=1e-6)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import dataset.dataset as ds
+import dataset.set_of_dataset as sds
+from model import grouplearner
+from optimizer import optimizer as op
+from optimizer import spec
+
+
+@pytest.fixture(autouse=True)
+def keras_sgd(monkeypatch):
+    # the learners call Optimizer.get_gradients, which TF >= 2.11 keeps only on the legacy Keras optimizers
+    if not hasattr(tf.keras.optimizers.SGD, 'get_gradients') and hasattr(tf.keras.optimizers, 'legacy'):
+        monkeypatch.setattr(tf.keras.optimizers, 'SGD', tf.keras.optimizers.legacy.SGD)
+
+
+def make_task(seed, n_train=64, n_test=32, row=4):
+    rng = np.random.RandomState(seed)
+    task = ds.DataSet.__new__(ds.DataSet)
+    task.x_train = rng.randint(0, 256, (n_train, row, row)).astype(np.uint8)
+    task.y_train = rng.randint(0, 10, n_train).astype(np.int64)
+    task.x_test = rng.randint(0, 256, (n_test, row, row)).astype(np.uint8)
+    task.y_test = rng.randint(0, 10, n_test).astype(np.int64)
+    task.d_in = row * row
+    task.n_train = n_train
+    task.n_test = n_test
+
+    return task
+
+
+@pytest.mark.parametrize('model', ['ResidentSingle', 'ResidentOEWC'])
+def test_resident_group_learner_end_to_end(model, tmp_path):
+    n_task = 3
+    set_of_datasets = sds.SetOfDataSet.__new__(sds.SetOfDataSet)
+    set_of_datasets.list = [make_task(i) for i in range(n_task)]
+    set_of_datasets.n_task = n_task
+    set_of_datasets.base = None
+
+    model_dir = str(tmp_path / model)
+    learning_specs = [spec.LearningSpec(1, 16, 64, n_task, model_dir, spec.OptimizerSpec(op.SGDOptimizer(5e-2), 16),
+                                        4, 1) for _ in range(n_task)]
+    run_config = tf.estimator.RunConfig(model_dir=model_dir)
+
+    ModelClass = getattr(grouplearner, 'Group' + model + 'Learner')
+    eval_matrix = ModelClass(set_of_datasets, learning_specs, n_task, run_config).train_and_evaluate()
+
+    assert eval_matrix.shape == (n_task, n_task)
+    # random labels: only the range of the accuracies is known
+    assert np.all(eval_matrix >= 0) and np.all(eval_matrix <= 1)
+    assert np.all(eval_matrix[np.triu_indices(n_task, 1)] == 0)
+    # three tasks of 64 rows in batches of 16
+    assert tf.train.latest_checkpoint(model_dir).endswith('model.ckpt-12')
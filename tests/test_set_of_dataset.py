@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import dataset.dataset as ds
+import dataset.set_of_dataset as sds
+
+
+class RandTask(ds.DataSet):
+    # draws every array from the global stream, like the Rand* families
+    def __init__(self, n_row):
+        self.x_train = np.random.randint(0, 256, (n_row, 4, 4)).astype(np.uint8)
+        self.y_train = np.random.permutation(n_row)
+        self.x_test = np.random.randint(0, 256, (n_row // 2, 4, 4)).astype(np.uint8)
+        self.y_test = np.random.permutation(n_row // 2)
+        self.d_in = 16
+        self.n_train = n_row
+        self.n_test = n_row // 2
+
+
+class SetOfRandTask(sds.SetOfDataSet):
+    def generate(self):
+        self.list = self.build_all(RandTask, 32)
+
+
+def build_tasks(monkeypatch, n_worker, seed=7, n_task=3):
+    monkeypatch.setattr(sds.SetOfDataSet, 'n_worker', n_worker)
+    monkeypatch.setattr(sds.SetOfDataSet, 'seed', seed)
+    # the global stream must not leak into the tasks
+    np.random.seed(n_worker)
+
+    return SetOfRandTask(n_task).list
+
+
+@pytest.mark.parametrize('n_worker', [1, 2])
+def test_worker_count_does_not_change_tasks(monkeypatch, n_worker):
+    expected = build_tasks(monkeypatch, 0)
+    tasks = build_tasks(monkeypatch, n_worker)
+
+    assert len(tasks) == len(expected)
+    for task, reference in zip(tasks, expected):
+        for name in ['x_train', 'y_train', 'x_test', 'y_test']:
+            assert np.asarray(getattr(task, name)).tobytes() == getattr(reference, name).tobytes()
+
+
+def test_tasks_differ_within_a_set(monkeypatch):
+    tasks = build_tasks(monkeypatch, 0)
+
+    assert tasks[0].x_train.tobytes() != tasks[1].x_train.tobytes()
+
+
+class RandTaskView(ds.DataSetView):
+    def __init__(self, base):
+        super(RandTaskView, self).__init__(base, np.random.permutation(base.d_in))
+
+
+class SetOfRandTaskView(sds.SetOfDataSet):
+    def generate(self):
+        base = RandTask(32)
+        base.row = 4
+        base.x_train = base.x_train.reshape(32, -1)
+        base.x_test = base.x_test.reshape(16, -1)
+        self.list = self.build_all(RandTaskView, base)
+
+
+def test_streaming_views_are_built_eagerly_with_a_notice(monkeypatch, capsys):
+    monkeypatch.setattr(sds.SetOfDataSet, 'streaming', True)
+    monkeypatch.setattr(sds.SetOfDataSet, 'seed', 7)
+
+    tasks = SetOfRandTaskView(3).list
+
+    assert isinstance(tasks, list) and len(tasks) == 3
+    assert 'Streaming ignored: RandTaskView' in capsys.readouterr().out
@@ -11,6 +11,9 @@ from optimizer import metric
 
 from result import logger
 
+from dataset import cache
+from dataset import set_of_dataset
+
 
 def main(argv):
     parser = argparse.ArgumentParser(description='Homeostatic Synapse')
@@ -33,6 +36,23 @@ def main(argv):
     parser.add_argument('--n_task', type=int, default=10, help='Number of tasks')
     parser.add_argument('--n_block', type=int, default=7, help='Number of blocks in BPERM')
     parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--cache_dir', type=str, default='', help='directory of the task dataset cache')
+    parser.add_argument('--cache_size', type=float, default=20.0, help='size limit of the task cache (GB)')
+    parser.add_argument('--verify_cache', action='store_true', help='checksum every cached array on each load')
+    parser.add_argument('--n_worker', type=int, default=0, help='processes for task generation (0, 1: in process); tasks depend only on --seed')
+    parser.add_argument('--streaming', action='store_true', help='build tasks on demand with prefetch of the next task (view families are built eagerly)')
+    parser.add_argument('--n_prefetch', type=int, default=1, help='batches prefetched by the input pipeline (-1: autotune)')
+    parser.add_argument('--n_parallel', type=int, default=1, help='parallel calls of the input preprocessing (-1: autotune)')
+    parser.add_argument('--cache_input', action='store_true', help='cache the fed examples inside the input pipeline')
+    parser.add_argument('--n_eval_batch', type=int, default=1000, help='evaluation batch size (-1: autotune)')
+    parser.add_argument('--eval_memory', type=float, default=256, help='memory cap of an autotuned evaluation batch (MB)')
+    parser.add_argument('--fisher_dtype', type=str, default='float32', help='stored fisher precision: float32, float16 or int8 (QEWC falls back to int8 rows for float32)')
+    parser.add_argument('--fisher_scale', type=str, default='tensor', help='fisher quantization scale: tensor or row')
+    parser.add_argument('--fisher_budget', type=float, default=1.0, help='fraction of fisher entries kept in the penalty (1: dense)')
+    parser.add_argument('--fisher_samples', type=int, default=0, help='examples of the post-task fisher estimation (0: accumulate while training)')
+    parser.add_argument('--fisher_batch', type=int, default=500, help='examples per batch of the post-task fisher estimation')
+    parser.add_argument('--penalty_gradient', type=str, default='autodiff', help='EWC penalty gradient: autodiff, analytic or fused_sgd')
+    parser.add_argument('--imm_mode', type=str, default='mean', help='IMM merge: mean or mode (fisher-weighted)')
     parser.add_argument('--save_path', type=str, default='new_result', help='save models')
 
     args = parser.parse_args()
@@ -56,6 +76,13 @@ def main(argv):
 
     model_dir = args.model + args.data
     np.random.seed(seed)
+    if args.cache_dir:
+        set_of_dataset.SetOfDataSet.cache = cache.TaskCache(args.cache_dir, int(args.cache_size * 2**30),
+                                                             args.verify_cache)
+    set_of_dataset.SetOfDataSet.n_worker = args.n_worker
+    set_of_dataset.SetOfDataSet.seed = seed
+    set_of_dataset.SetOfDataSet.streaming = args.streaming
+
     DataClass = getattr(importlib.import_module('dataset.set_of_dataset'), 'SetOf' + args.data)
 
     if args.data[-5:] == 'BPERM':
@@ -75,7 +102,16 @@ def main(argv):
         opt = op.SGDOptimizer(learning_rates[i])
         opt_spec = spec.OptimizerSpec(opt, d_in)
         learning_specs.append(spec.LearningSpec(n_epoch, n_batch, n_train, n_task,
-                                                model_dir, opt_spec, n_fed_step, alpha))
+                                                model_dir, opt_spec, n_fed_step, alpha,
+                                                n_prefetch=args.n_prefetch, n_parallel=args.n_parallel,
+                                                cache=args.cache_input, n_eval_batch=args.n_eval_batch,
+                                                eval_memory=args.eval_memory, fisher_dtype=args.fisher_dtype,
+                                                fisher_scale=args.fisher_scale, fisher_budget=args.fisher_budget,
+                                                fisher_samples=args.fisher_samples,
+                                                fisher_batch=args.fisher_batch,
+                                                penalty_gradient=args.penalty_gradient,
+                                                imm_mode=args.imm_mode,
+                                                seed=seed))
 
     ModelClass = getattr(importlib.import_module('model.grouplearner'), 'Group'+args.model+'Learner')
     my_grouplearner = ModelClass(set_of_datasets, learning_specs, n_task, run_config)